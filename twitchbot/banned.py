@@ -0,0 +1,191 @@
+import os
+import time
+from collections import deque
+
+
+def read_banned(path):
+    """
+    Read a list of comma-separated banned words from path. If not present, return an empty list.
+    """
+    try:
+        with open(path, encoding='utf-8') as f:
+            words = f.read()
+    except FileNotFoundError:
+        print(f"Alert: {path} not found. ")
+        return []
+    return [w.strip() for w in words.split(',') if w.strip()]
+
+
+class Matcher():
+    """
+    Aho-Corasick automaton over a list of words, which finds whether any of
+    them occurs in a text in a single pass over the text.
+
+    By default a word only matches as a whole, space-separated token; with
+    substring it matches anywhere. With case_fold, matching ignores case.
+    """
+    def __init__(self, words, case_fold=False, substring=False):
+        self.case_fold = case_fold
+        self.substring = substring
+        self.goto = [{}]  # state -> {char: next state}
+        self.fail = [0]
+        self.lengths = [()]  # state -> lengths of all words ending here, including via suffixes
+        for word in words:
+            self.add(word.casefold() if case_fold else word)
+        self.build()
+
+    def __bool__(self):
+        return len(self.goto) > 1
+
+    def add(self, word):
+        if not word:
+            return
+        state = 0
+        for c in word:
+            nxt = self.goto[state].get(c)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto[state][c] = nxt
+                self.goto.append({})
+                self.fail.append(0)
+                self.lengths.append(())
+            state = nxt
+        self.lengths[state] += (len(word),)
+
+    def build(self):
+        """
+        Compute failure links breadth-first, merging the outputs of each state's suffixes into it.
+        """
+        goto, fail, lengths = self.goto, self.fail, self.lengths
+        queue = deque(goto[0].values())  # depth 1 states fail to the root
+        while queue:
+            state = queue.popleft()
+            for c, nxt in goto[state].items():
+                f = fail[state]
+                while f and c not in goto[f]:
+                    f = fail[f]
+                fail[nxt] = goto[f].get(c, 0)
+                lengths[nxt] += lengths[fail[nxt]]
+                queue.append(nxt)
+
+    def search(self, text):
+        """
+        Return True if any word occurs in text.
+        """
+        if len(self.goto) == 1:
+            return False
+        if self.case_fold:
+            text = text.casefold()
+        goto, fail, lengths = self.goto, self.fail, self.lengths
+        substring = self.substring
+        n = len(text)
+        state = 0
+        for i, c in enumerate(text):
+            while state and c not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(c, 0)
+            if lengths[state]:
+                if substring:
+                    return True
+                # whole tokens only: the match must be delimited by spaces or the ends of text
+                if i + 1 == n or text[i + 1] == ' ':
+                    for length in lengths[state]:
+                        start = i + 1 - length
+                        if start == 0 or text[start - 1] == ' ':
+                            return True
+        return False
+
+
+class WatchedFile():
+    """
+    A comma-separated list file that is reloaded when its mtime changes,
+    checked at most every check_interval seconds.
+    """
+    def __init__(self, path, check_interval=1.0):
+        self.path = path
+        self.check_interval = check_interval
+        self.mtime = None
+        self.last_check = 0.0
+
+    def mtime_of(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def changed(self):
+        """
+        Return True if the file changed since it was last loaded.
+        """
+        now = time.monotonic()
+        if now - self.last_check < self.check_interval:
+            return False
+        self.last_check = now
+        return self.mtime_of() != self.mtime
+
+
+class BannedWords(WatchedFile):
+    """
+    Banned word list loaded from a file and compiled into a Matcher. The file
+    is reloaded when it changes, and on_added, if given, is called with a
+    Matcher over just the newly banned words so they can be pruned elsewhere.
+    """
+    def __init__(self, path='banned.txt', case_fold=False, substring=False, check_interval=1.0,
+                 on_added=None):
+        super().__init__(path, check_interval)
+        self.case_fold = case_fold
+        self.substring = substring
+        self.on_added = on_added
+        self.words = []
+        self.matcher = Matcher([])
+        self.load()
+
+    def load(self):
+        """
+        (Re)load the word list, returning the words that weren't banned before.
+        """
+        self.mtime = self.mtime_of()
+        words = read_banned(self.path)
+        added = sorted(set(words) - set(self.words))
+        self.words = words
+        self.matcher = Matcher(words, self.case_fold, self.substring)
+        return added
+
+    def check(self):
+        """
+        Reload the list if the file changed, calling on_added for any new words.
+        """
+        if not self.changed():
+            return
+        added = self.load()
+        print(f'[BOT] {self.path} reloaded: {len(self.words)} banned words')
+        if added and self.on_added is not None:
+            self.on_added(Matcher(added, self.case_fold, self.substring))
+
+    def search(self, text):
+        """
+        Return True if text contains a banned word, reloading the list first if it changed.
+        """
+        self.check()
+        return self.matcher.search(text)
+
+
+class IgnoredUsers(WatchedFile):
+    """
+    Users whose messages are ignored (other bots, spammers), read from a file
+    of comma-separated names and reloaded when it changes. Names match case-insensitively.
+    """
+    def __init__(self, path='ignored.txt', check_interval=1.0):
+        super().__init__(path, check_interval)
+        self.users = frozenset()
+        self.load()
+
+    def load(self):
+        self.mtime = self.mtime_of()
+        self.users = frozenset(user.casefold() for user in read_banned(self.path))
+
+    def __contains__(self, user):
+        if self.changed():
+            self.load()
+            print(f'[BOT] {self.path} reloaded: {len(self.users)} ignored users')
+        return user.casefold() in self.users
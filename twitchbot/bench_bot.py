@@ -0,0 +1,121 @@
+"""
+End-to-end benchmark of TwitchBot against the local fake IRC server: ingest
+rate (lines per second), post latency, PONG latency and RSS growth, for each
+model order.
+
+Usage: python bench_bot.py [chat.log] [--lines N] [--rate R] [--orders 1 2 3]
+                           [--wait S] [--ping S]
+
+The log is one raw IRC line per line, as received from the server. Without
+one, synthetic chat is used. With --rate 0 (the default) lines are replayed
+as fast as the bot reads them. Each order runs its bot in a fresh process,
+so RSS growth isn't skewed by earlier runs. Unpaced, PONG latency is mostly
+the time to read the chat queued ahead of each PING.
+"""
+import argparse
+import asyncio
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import fakeirc
+import irc
+from twitchbot import TwitchBot
+
+ADMIN = 'benchadmin'
+
+
+class BenchBot(TwitchBot):
+    """
+    TwitchBot with rate limits high enough that they never delay a post.
+    """
+    def new_transport(self):
+        return irc.IRCConnection(self.host, self.port, encoding=self.encoding,
+                                 global_limit=(1000, 1), channel_limit=(1000, 1),
+                                 on_write=self.record_write)
+
+
+def rss():
+    """
+    Resident set size of this process in bytes, or None where /proc isn't available.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def run_bot(port, order, wait):
+    """
+    Runs in a child process: connect a bot to the server and run it until the admin's exit.
+    """
+    bot = BenchBot('benchbot', order=order, admin=ADMIN, wait=wait, write=False, refresh=False,
+                   pool_size=0)
+    # keep the bot's console output out of the report
+    sys.stdout = open(os.devnull, 'w')
+    bot.connect('127.0.0.1', port, 'oauth:bench', 'bench')
+    before = rss()
+    bot.run()
+    after = rss()
+    growth = after - before if before is not None and after is not None else None
+    return bot.msg_count, growth
+
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+async def bench_order(executor, lines, order, rate, wait, ping):
+    server = fakeirc.FakeIRCServer(lines, rate=rate, ping_interval=ping, admin=ADMIN)
+    port = await server.start()
+    loop = asyncio.get_running_loop()
+    msg_count, growth = await loop.run_in_executor(executor, run_bot, port, order, wait)
+    await server.wait_closed()
+    await server.close()
+    elapsed = server.finished - server.started
+    return {'order': order, 'lines': msg_count, 'rate': msg_count / elapsed,
+            'posts': len(server.posts), 'post_latency': server.post_latencies(wait),
+            'pong_latency': server.pong_latencies, 'rss_growth': growth}
+
+
+def print_result(r):
+    ms = lambda values, p: 1000 * percentile(values, p)
+    growth = 'n/a' if r['rss_growth'] is None else f"{r['rss_growth'] / 1e6:.1f} MB"
+    print(f"order {r['order']}: {r['lines']:,} lines at {r['rate']:,.0f} lines/s, {r['posts']} posts")
+    print(f"  post latency p50 {ms(r['post_latency'], 50):.1f} ms, p99 {ms(r['post_latency'], 99):.1f} ms")
+    print(f"  pong latency p50 {ms(r['pong_latency'], 50):.1f} ms, max {ms(r['pong_latency'], 100):.1f} ms")
+    print(f'  RSS growth {growth}')
+
+
+async def main_async(args, lines):
+    for order in args.orders:
+        # one process per order, so each bot starts from a clean heap
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            result = await bench_order(executor, lines, order, args.rate, args.wait, args.ping)
+        print_result(result)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('log', nargs='?', help='recorded chat log, one raw IRC line per line')
+    parser.add_argument('--lines', type=int, default=100000, help='synthetic log size')
+    parser.add_argument('--rate', type=float, default=0, help='lines per second, 0 for unpaced')
+    parser.add_argument('--orders', type=int, nargs='+', default=[1, 2, 3])
+    parser.add_argument('--wait', type=float, default=1.0, help='seconds between bot posts')
+    parser.add_argument('--ping', type=float, default=.5, help='seconds between PINGs')
+    args = parser.parse_args()
+
+    if args.log:
+        with open(args.log, encoding='utf-8', errors='replace') as f:
+            lines = [line for line in f.read().splitlines() if not line.startswith('PING')]
+    else:
+        lines = fakeirc.synthetic_chat(args.lines)
+    asyncio.run(main_async(args, lines))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""
+Benchmark of IRC line parsing throughput (lines per second): irc.parse_privmsg
+against the original per-line regex helpers (get_user, get_message, filter_at).
+
+Usage: python bench_parser.py [chat.log] [--lines N]
+
+The log is one raw IRC line per line, as received from the server. Without
+one, a synthetic log of tagged Twitch traffic is used.
+"""
+import argparse
+import random
+import re
+import time
+
+import irc
+
+TAGS = ('@badge-info=subscriber/{m};badges=subscriber/{m},premium/1;client-nonce={n:032x};'
+        'color=#{c:06X};display-name={u};emotes=;first-msg=0;flags=;id={n:08x}-0000-0000-0000-000000000000;'
+        'mod=0;returning-chatter=0;room-id=12345;subscriber=1;tmi-sent-ts={t};turbo=0;'
+        'user-id={i};user-type= ')
+
+
+def legacy_get_user(line):
+    line = re.search(r":.+?!", line)
+    if line:
+        return line.group(0)[1:-1]
+    return ''
+
+
+def legacy_get_message(line):
+    line = re.search(r" :.+", line)
+    if line:
+        return line.group(0)[2:]
+    return ''
+
+
+def legacy_filter_at(message):
+    return re.sub(r'@', '', message)
+
+
+def synthetic_log(lines=200000, users=5000):
+    """
+    Tagged PRIVMSGs from a busy channel with some USERNOTICE, CLEARCHAT and PING lines mixed in.
+    """
+    words = ['KEKW', 'LUL', 'PogChamp', 'the', 'a', 'is', 'what', 'that', 'play', 'chat', '@streamer',
+             'lol', 'no', 'yes', 'gg', 'ez', 'clip', 'it', 'W', 'L']
+    log = []
+    for n in range(lines):
+        i = random.randrange(users)
+        user = f'user{i}'
+        r = random.random()
+        if r < .01:
+            log.append('PING :tmi.twitch.tv')
+        elif r < .03:
+            log.append(f'@room-id=12345;target-user-id={i} :tmi.twitch.tv CLEARCHAT #channel :{user}')
+        elif r < .05:
+            log.append(TAGS.format(m=i % 48, n=n, c=i * 7919 % 0xFFFFFF, u=user, t=n, i=i) +
+                       ':tmi.twitch.tv USERNOTICE #channel :resub message')
+        else:
+            text = ' '.join(random.choices(words, k=random.randint(1, 15)))
+            log.append(TAGS.format(m=i % 48, n=n, c=i * 7919 % 0xFFFFFF, u=user, t=n, i=i) +
+                       f':{user}!{user}@{user}.tmi.twitch.tv PRIVMSG #channel :{text}')
+    return log
+
+
+def bench(name, fn, log):
+    start = time.perf_counter()
+    fn(log)
+    rate = len(log) / (time.perf_counter() - start)
+    print(f'{name:>16}: {rate:12,.0f} lines/s')
+
+
+def run_legacy(log):
+    for line in log:
+        user = legacy_get_user(line)
+        message = legacy_filter_at(legacy_get_message(line))
+
+
+def run_parser(log):
+    for line in log:
+        msg = irc.parse_privmsg(line)
+        if msg is None:
+            continue
+        user = msg.user
+        message = msg.text.replace('@', '')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('log', nargs='?', help='recorded chat log, one raw IRC line per line')
+    parser.add_argument('--lines', type=int, default=200000, help='synthetic log size')
+    args = parser.parse_args()
+
+    if args.log:
+        with open(args.log, encoding='utf-8', errors='replace') as f:
+            log = f.read().splitlines()
+    else:
+        log = synthetic_log(args.lines)
+    bench('regex helpers', run_legacy, log)
+    bench('parse_privmsg', run_parser, log)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""
+Micro-benchmark comparing generate_sentence throughput (tokens per second) of
+MarkovModel against the original dict-of-dicts bot, which rebuilds NumPy
+arrays and calls np.random.choice for every generated word.
+
+Usage: python bench_sampling.py [corpus.txt] [--order N] [--sentences N]
+"""
+import argparse
+import random
+import time
+
+import numpy as np
+
+import mcbot as mcb
+
+
+class LegacyMCBot():
+    """
+    The pre-MarkovModel order-2 bot, kept here only as a baseline.
+    """
+    def __init__(self):
+        self.word_dict = {}
+
+    def add_text(self, text):
+        word_list = text.split()
+        result = self.word_dict
+        for i in range(0, len(word_list) - 2):
+            key = (word_list[i], word_list[i + 1])
+            value = word_list[i + 2]
+            if key not in result:
+                result[key] = {}
+            result[key][value] = result[key].get(value, 0) + 1
+
+    def next_word(self, key):
+        if key not in self.word_dict:
+            key = self.random_key()
+        weights = np.array(list(self.word_dict[key].values()))
+        weight_proba = weights / sum(weights)
+        return np.random.choice(list(self.word_dict[key].keys()), p=weight_proba)
+
+    def random_key(self):
+        key_list = list(self.word_dict.keys())
+        return key_list[np.random.choice(len(key_list))]
+
+    def generate_sentence(self, word_limit=20):
+        curr, next = self.random_key()
+        sentence = [curr, next]
+        while len(sentence) <= word_limit:
+            curr, next = next, self.next_word((curr, next))
+            sentence.append(next)
+        return ' '.join(sentence)
+
+
+def synthetic_corpus(lines=20000, vocab=2000, length=12):
+    """
+    Zipf-distributed chat lines, roughly the shape of a busy channel.
+    """
+    words = [f'w{i}' for i in range(vocab)]
+    weights = [1 / (i + 1) for i in range(vocab)]
+    return [' '.join(random.choices(words, weights, k=length)) for _ in range(lines)]
+
+
+def tokens_per_second(bot, sentences, word_limit):
+    tokens = 0
+    start = time.perf_counter()
+    for _ in range(sentences):
+        tokens += len(bot.generate_sentence(word_limit=word_limit).split())
+    return tokens / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('corpus', nargs='?', help='text file with one message per line')
+    parser.add_argument('--order', type=int, default=2)
+    parser.add_argument('--sentences', type=int, default=2000)
+    parser.add_argument('--word-limit', type=int, default=20)
+    args = parser.parse_args()
+
+    if args.corpus:
+        with open(args.corpus, encoding='utf-8') as f:
+            lines = f.read().splitlines()
+    else:
+        lines = synthetic_corpus()
+
+    model = mcb.MarkovModel(order=args.order)
+    for line in lines:
+        model.add_text(line)
+    results = {f'MarkovModel(order={args.order})': tokens_per_second(model, args.sentences, args.word_limit)}
+    if args.order == 2:
+        legacy = LegacyMCBot()
+        for line in lines:
+            legacy.add_text(line)
+        results['legacy MCBot2'] = tokens_per_second(legacy, args.sentences // 10 or 1, args.word_limit)
+
+    for name, rate in results.items():
+        print(f'{name:>24}: {rate:12,.0f} tokens/s')
+
+
+if __name__ == '__main__':
+    main()
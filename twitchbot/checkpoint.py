@@ -0,0 +1,222 @@
+"""
+Crash-safe checkpoints of a running bot.
+
+The model is saved periodically as a snapshot (see snapshot.py) from a
+forked child process, which gets a copy-on-write view of the tables, so the
+bot keeps reading and training while it's written. A small JSON state file
+holds the counters and settings and names the snapshot it belongs to, and
+the window file of a bot that trains through a sliding window or decay, so
+replacing it commits the whole checkpoint atomically.
+
+Every message accepted for training is also appended to a write-ahead log,
+numbered by the bot's message count. On restore, the messages that came
+after the checkpoint are trained on again. Where os.fork isn't available
+(Windows), the snapshot is written by the calling thread instead.
+"""
+import glob
+import json
+import os
+import time
+import warnings
+
+CHECKPOINT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'checkpoint')
+STATE_FILE = 'state.json'
+
+
+class WriteAheadLog():
+    """
+    Messages appended as [seq, text] JSON lines to segment files wal-<n>.jsonl.
+    A new segment is started at each checkpoint, so older segments can be
+    deleted once a checkpoint holds all of their messages. Lines are written
+    through as they come, so they survive the process dying, but aren't
+    synced to disk.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.file = None
+        # never append to a segment left by an earlier run, its last line may be cut off
+        self.segment = max(self.segments(), default=0) + 1
+
+    def path(self, n):
+        return os.path.join(self.directory, f'wal-{n}.jsonl')
+
+    def segments(self):
+        """
+        Return the numbers of the segment files on disk, in order.
+        """
+        segments = []
+        for path in glob.glob(os.path.join(self.directory, 'wal-*.jsonl')):
+            n = os.path.basename(path)[len('wal-'):-len('.jsonl')]
+            if n.isdigit():
+                segments.append(int(n))
+        return sorted(segments)
+
+    def append(self, seq, text):
+        if self.file is None:
+            os.makedirs(self.directory, exist_ok=True)
+            # line buffered: each record is handed to the OS as it's written
+            self.file = open(self.path(self.segment), 'a', encoding='utf-8', buffering=1)
+        self.file.write(json.dumps([seq, text], ensure_ascii=False) + '\n')
+
+    def rotate(self):
+        """
+        Start a new segment. Returns its number; every older segment is complete.
+        """
+        self.close()
+        self.segment += 1
+        return self.segment
+
+    def prune(self, before):
+        """
+        Delete the segments numbered below before.
+        """
+        for n in self.segments():
+            if n < before:
+                try:
+                    os.remove(self.path(n))
+                except OSError:
+                    pass
+
+    def records(self, after=0):
+        """
+        Yield (seq, text) for every logged message with seq > after, in order.
+        Lines that can't be parsed, like one cut off by a crash, are skipped.
+        """
+        for n in self.segments():
+            with open(self.path(n), encoding='utf-8', errors='replace') as f:
+                for line in f:
+                    try:
+                        seq, text = json.loads(line)
+                    except (ValueError, TypeError):
+                        continue
+                    if seq > after:
+                        yield seq, text
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class Checkpointer():
+    """
+    Writes checkpoints to directory and loads the last one back. At most one
+    checkpoint is written at a time. print_message reports failures.
+    """
+    def __init__(self, directory=CHECKPOINT_DIR, print_message=print):
+        self.directory = directory
+        self.print_message = print_message
+        self.wal = WriteAheadLog(directory)
+        self.child = None  # pid of the process writing a checkpoint
+        self.count = 0  # checkpoints started
+
+    def load(self):
+        """
+        Return (snapshot path, state) of the last committed checkpoint. The
+        path is None if there's no checkpoint, and state is then empty.
+        """
+        try:
+            with open(os.path.join(self.directory, STATE_FILE), encoding='utf-8') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None, {}
+        return os.path.join(self.directory, state['model']), state
+
+    def load_window(self, state):
+        """
+        Return the window state saved with the checkpoint of state (see
+        window.SlidingWindow.state), or None if there is none.
+        """
+        if not state.get('window'):
+            return None
+        try:
+            with open(os.path.join(self.directory, state['window']), encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def save(self, model, state, wal_segment=None, window=None):
+        """
+        Start writing a checkpoint of model with state (a dict of JSON values).
+        If the model is trained through window, the window's state is saved
+        with it. Once it's committed, WAL segments below wal_segment are deleted.
+        Returns False if the previous checkpoint is still being written.
+        The caller must keep the model and window from changing until this returns.
+        """
+        if self.busy():
+            return False
+        self.count += 1
+        # time_ns keeps names unique across restarts, even if the clock is coarse
+        stamp = time.time_ns()
+        state = dict(state, model=f'model-{stamp}.snap', wal=wal_segment,
+                     window=None if window is None else f'window-{stamp}.json')
+        os.makedirs(self.directory, exist_ok=True)
+        if not hasattr(os, 'fork'):
+            self.write(model, state, window)
+            return True
+        with warnings.catch_warnings():
+            # The child only runs this thread. The caller's model lock was
+            # taken before the fork, so the child's copy of the model is
+            # consistent, but the child must never take that lock (it stays
+            # held), nor any other lock another thread may have held at the
+            # fork: the log writer's and profiler's locks, the worker's job
+            # queue, stdout's buffer. It only reads the model and writes
+            # files, never prints, and leaves with os._exit.
+            warnings.simplefilter('ignore', DeprecationWarning)
+            pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                self.write(model, state, window)
+                code = 0
+            finally:
+                os._exit(code)
+        self.child = pid
+        return True
+
+    def write(self, model, state, window=None):
+        """
+        Write the snapshot and window, commit the state file, then delete what it replaces.
+        """
+        # without fork this runs on the live model, which mustn't start delta tracking
+        model.save(os.path.join(self.directory, state['model']), track=False)
+        if window is not None:
+            with open(os.path.join(self.directory, state['window']), 'w', encoding='utf-8') as f:
+                json.dump(window.state(), f)
+        path = os.path.join(self.directory, STATE_FILE)
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+        os.replace(path + '.tmp', path)
+        current = (state['model'], state['window'])
+        for old in (glob.glob(os.path.join(self.directory, 'model-*.snap'))
+                    + glob.glob(os.path.join(self.directory, 'window-*.json'))):
+            if os.path.basename(old) not in current:
+                try:
+                    os.remove(old)
+                except OSError:
+                    # still mapped by a process on Windows, removed by a later checkpoint
+                    pass
+        if state['wal'] is not None:
+            self.wal.prune(state['wal'])
+
+    def busy(self, wait=False):
+        """
+        Return True if a checkpoint is still being written, reaping the child
+        process once it's done. With wait, block until it is.
+        """
+        if self.child is None:
+            return False
+        pid, status = os.waitpid(self.child, 0 if wait else os.WNOHANG)
+        if pid == 0:
+            return True
+        self.child = None
+        if status != 0:
+            self.print_message(f'checkpoint failed, exit status {status}')
+        return False
+
+    def close(self):
+        """
+        Wait for a checkpoint being written and close the WAL.
+        """
+        self.busy(wait=True)
+        self.wal.close()
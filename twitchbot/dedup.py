@@ -0,0 +1,114 @@
+"""
+Near-duplicate filter for chat, so copypasta and emote floods are trained
+on once instead of once per copy.
+"""
+import time
+from collections import deque
+
+import numpy as np
+
+MASK = (1 << 64) - 1
+
+
+class NearDuplicateFilter():
+    """
+    Flags messages that are near-copies of one seen in the last window seconds.
+
+    Each message is case-folded, its whitespace collapsed, and cut into
+    overlapping shingles of <shingle> characters. A MinHash signature of
+    num_hashes values estimates the Jaccard similarity of two messages'
+    shingle sets, and locality-sensitive hashing (the signature split into
+    bands; messages that agree on any band are candidates) finds similar
+    earlier messages without comparing against all of them. A message whose
+    estimated similarity to a candidate is at least threshold is a copy of it.
+
+    The first keep copies of a message pass and later ones are flagged. Only
+    messages that pass are remembered, so a flood that goes on for longer than
+    the window lets one more copy through each window. At most max_messages
+    are remembered. Work per message is O(message length).
+    """
+    def __init__(self, window=30.0, threshold=.7, keep=1, shingle=4, num_hashes=16, bands=8,
+                 max_messages=10000, seed=0):
+        if num_hashes % bands:
+            raise ValueError('num_hashes must be a multiple of bands')
+        self.window = window
+        self.threshold = threshold
+        self.keep = keep
+        self.shingle = shingle
+        self.bands = bands
+        self.max_messages = max_messages
+        rng = np.random.default_rng(seed)
+        # multiply-add hashes mod 2^64, one per signature value; odd multipliers are invertible
+        self.mult = rng.integers(0, MASK, num_hashes, dtype=np.uint64, endpoint=True) | np.uint64(1)
+        self.add = rng.integers(0, MASK, num_hashes, dtype=np.uint64, endpoint=True)
+        self.recent = deque()  # (time, message id, band keys) of remembered messages
+        self.band_index = {}  # band key -> id of the newest remembered message with it
+        self.signatures = {}  # message id -> (signature, copies passed)
+        self.next_id = 0
+        self.seen = 0
+        self.dropped = 0
+
+    def signature(self, text):
+        """
+        Return the MinHash signature of text, as a uint64 array of num_hashes values.
+        """
+        text = ' '.join(text.casefold().split())
+        k = self.shingle
+        if len(text) <= k:
+            hashes = [hash(text)]
+        else:
+            hashes = {hash(text[i:i + k]) for i in range(len(text) - k + 1)}
+        h = np.fromiter(hashes, dtype=np.int64, count=len(hashes)).view(np.uint64)
+        return (h[:, None] * self.mult + self.add).min(axis=0)
+
+    def band_keys(self, sig):
+        data = sig.tobytes()
+        step = len(data) // self.bands
+        return [(b, data[i:i + step]) for b, i in enumerate(range(0, len(data), step))]
+
+    def expire(self, now):
+        recent, band_index, signatures = self.recent, self.band_index, self.signatures
+        oldest = now - self.window
+        while recent and (recent[0][0] < oldest or len(recent) > self.max_messages):
+            _, msg_id, keys = recent.popleft()
+            del signatures[msg_id]
+            for key in keys:
+                if band_index.get(key) == msg_id:
+                    del band_index[key]
+
+    def is_duplicate(self, text, now=None):
+        """
+        Return True if text is a near-copy of a recent message that has already
+        passed keep times; otherwise remember it and return False.
+        """
+        now = time.time() if now is None else now
+        self.expire(now)
+        self.seen += 1
+        sig = self.signature(text)
+        keys = self.band_keys(sig)
+        signatures = self.signatures
+        for key in keys:
+            msg_id = self.band_index.get(key)
+            if msg_id is None:
+                continue
+            other, copies = signatures[msg_id]
+            if np.count_nonzero(sig == other) >= self.threshold * len(sig):
+                if copies >= self.keep:
+                    self.dropped += 1
+                    return True
+                signatures[msg_id] = (other, copies + 1)
+                return False
+        msg_id = self.next_id
+        self.next_id += 1
+        signatures[msg_id] = (sig, 1)
+        for key in keys:
+            self.band_index[key] = msg_id
+        self.recent.append((now, msg_id, keys))
+        return False
+
+    def drop_rate(self):
+        return self.dropped / self.seen if self.seen else 0.0
+
+    def summary(self):
+        return (f'duplicates: {self.dropped:,} of {self.seen:,} messages dropped '
+                f'({100 * self.drop_rate():.1f}%)')
@@ -0,0 +1,171 @@
+"""
+Local stand-in for the Twitch IRC server, for load tests and benchmarks.
+
+It answers PASS/NICK/JOIN like Twitch does (each JOIN gets the names list
+ending in "End of /NAMES list"), then replays chat lines at a given rate,
+sends PINGs, and records the bot's PONGs and PRIVMSGs with their arrival times.
+"""
+import asyncio
+import random
+import time
+from array import array
+from bisect import bisect_left
+from collections import deque
+
+import irc
+
+
+def synthetic_chat(lines=100000, channel='bench', users=2000, words=5000, seed=0):
+    """
+    Tagged PRIVMSG lines with Zipf-distributed words, so the vocabulary keeps
+    growing slowly like real chat. channel may be a list to spread lines over.
+    """
+    rng = random.Random(seed)
+    channels = [channel] if isinstance(channel, str) else list(channel)
+    vocab = [f'w{i}' for i in range(words)]
+    weights = [1 / (i + 1) for i in range(words)]
+    log = []
+    for n in range(lines):
+        user = f'user{rng.randrange(users)}'
+        text = ' '.join(rng.choices(vocab, weights, k=rng.randint(1, 15)))
+        log.append(f'@id={n};tmi-sent-ts={n} :{user}!{user}@{user}.tmi.twitch.tv '
+                   f'PRIVMSG #{channels[n % len(channels)]} :{text}')
+    return log
+
+
+class FakeIRCServer():
+    """
+    Serves one client at a time on host:port (port 0 picks a free one, see
+    .port after start). After the first JOIN, lines are replayed at rate
+    lines per second (0: as fast as the client reads them), and a PING is
+    sent every ping_interval seconds. When the replay is done, admin (if
+    given) sends "exit" to exit_channel so the bot shuts down.
+
+    Results: sent_times (send time of each replayed line), pong_latencies,
+    posts (a list of (time, channel, text)), started and finished. Times are
+    time.perf_counter() values.
+    """
+    def __init__(self, lines, rate=0, ping_interval=1.0, admin=None, exit_channel=None,
+                 host='127.0.0.1', port=0):
+        self.lines = lines
+        self.rate = rate
+        self.ping_interval = ping_interval
+        self.admin = admin
+        self.exit_channel = exit_channel
+        self.host = host
+        self.port = port
+        self.server = None
+        self.nick = ''
+        self.channels = []
+        self.sent_times = array('d')
+        self.pings = deque()  # send times of unanswered PINGs
+        self.pong_latencies = []
+        self.posts = []
+        self.started = None
+        self.finished = None
+        self.done = asyncio.Event()  # set when the client disconnects
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self.port
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def handle(self, reader, writer):
+        tasks = []
+        try:
+            while True:
+                raw = await reader.readline()
+                if not raw:
+                    break
+                now = time.perf_counter()
+                msg = irc.parse_line(raw.decode('utf-8', errors='replace').rstrip('\r\n'))
+                if msg is None:
+                    continue
+                if msg.command == 'NICK' and msg.params:
+                    self.nick = msg.params[0]
+                elif msg.command == 'JOIN' and msg.params:
+                    host = f'{self.nick}.tmi.twitch.tv'
+                    for channel in msg.params[0].split(','):
+                        channel = channel.lstrip('#')
+                        self.channels.append(channel)
+                        writer.write(f':{host} 353 {self.nick} = #{channel} :{self.nick}\r\n'
+                                     f':{host} 366 {self.nick} #{channel} :End of /NAMES list\r\n'
+                                     .encode('utf-8'))
+                    if not tasks:
+                        tasks = [asyncio.create_task(self.replay(writer)),
+                                 asyncio.create_task(self.ping_loop(writer))]
+                elif msg.command == 'PONG':
+                    if self.pings:
+                        self.pong_latencies.append(now - self.pings.popleft())
+                elif msg.command == 'PRIVMSG':
+                    self.posts.append((now, msg.channel, msg.text))
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.finished = time.perf_counter()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            writer.close()
+            self.done.set()
+
+    async def replay(self, writer):
+        """
+        Write the chat lines, paced to rate, followed by the admin's exit command.
+        """
+        sent_times = self.sent_times
+        self.started = time.perf_counter()
+        i = 0
+        n = len(self.lines)
+        while i < n:
+            if self.rate:
+                # every line that is due by now, and at least one
+                due = int((time.perf_counter() - self.started) * self.rate) + 1
+                end = min(n, max(due, i + 1))
+            else:
+                end = min(n, i + 256)
+            writer.write(''.join(line + '\r\n' for line in self.lines[i:end]).encode('utf-8'))
+            # lines count as sent once the client has read enough for them to fit in the socket buffer
+            await writer.drain()
+            now = time.perf_counter()
+            sent_times.extend(now for _ in range(end - i))
+            i = end
+            if self.rate and i < n:
+                await asyncio.sleep(max(0.0, self.started + i / self.rate - now))
+        if self.admin:
+            channel = self.exit_channel or (self.channels[0] if self.channels else '')
+            writer.write(f':{self.admin}!{self.admin}@{self.admin}.tmi.twitch.tv '
+                         f'PRIVMSG #{channel} :exit\r\n'.encode('utf-8'))
+            await writer.drain()
+
+    async def ping_loop(self, writer):
+        while True:
+            await asyncio.sleep(self.ping_interval)
+            self.pings.append(time.perf_counter())
+            writer.write(b'PING :tmi.twitch.tv\r\n')
+            await writer.drain()
+
+    async def wait_closed(self):
+        await self.done.wait()
+
+    def post_latencies(self, wait):
+        """
+        Estimate how long each post took: a bot posts on the first message it
+        gets <wait> seconds after its last post, so each post is timed from the
+        first line sent at least wait seconds after the previous post (or after
+        the replay started).
+        """
+        latencies = []
+        last = self.started
+        for t, _, _ in self.posts:
+            i = bisect_left(self.sent_times, last + wait)
+            if i < len(self.sent_times) and self.sent_times[i] <= t:
+                latencies.append(t - self.sent_times[i])
+            last = t
+        return latencies
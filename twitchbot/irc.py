@@ -0,0 +1,341 @@
+import asyncio
+import heapq
+import time
+
+TAG_ESCAPES = {':': ';', 's': ' ', '\\': '\\', 'r': '\r', 'n': '\n'}
+PRIVMSG = frozenset(('PRIVMSG',))
+
+# outbound priorities, lowest first
+PRIORITY_PONG = 0
+PRIORITY_COMMAND = 1
+PRIORITY_MESSAGE = 2
+
+
+class Message():
+    """
+    A parsed IRC line: IRCv3 tags, prefix, command and params, where the
+    trailing text (after ' :') is the last param. Tags are kept raw and only
+    split into a dict when first accessed.
+    """
+    __slots__ = ('raw_tags', 'parsed_tags', 'prefix', 'command', 'params')
+
+    def __init__(self, raw_tags, prefix, command, params):
+        self.raw_tags = raw_tags
+        self.parsed_tags = None
+        self.prefix = prefix
+        self.command = command
+        self.params = params
+
+    @property
+    def tags(self):
+        if self.parsed_tags is None:
+            self.parsed_tags = parse_tags(self.raw_tags) if self.raw_tags else {}
+        return self.parsed_tags
+
+    @property
+    def user(self):
+        """
+        Nick of the sender, from a nick!user@host prefix.
+        """
+        nick, sep, _ = self.prefix.partition('!')
+        return nick if sep else ''
+
+    @property
+    def channel(self):
+        """
+        Target channel without the '#', or '' if the first param isn't a channel.
+        """
+        if self.params and self.params[0].startswith('#'):
+            return self.params[0][1:]
+        return ''
+
+    @property
+    def text(self):
+        """
+        Message text of a PRIVMSG (its last param).
+        """
+        return self.params[-1] if len(self.params) > 1 else ''
+
+    def __repr__(self):
+        return f'Message({self.raw_tags!r}, {self.prefix!r}, {self.command!r}, {self.params!r})'
+
+
+def unescape_tag(value):
+    out = []
+    i = 0
+    n = len(value)
+    while i < n:
+        c = value[i]
+        if c == '\\':
+            i += 1
+            if i < n:
+                out.append(TAG_ESCAPES.get(value[i], value[i]))
+        else:
+            out.append(c)
+        i += 1
+    return ''.join(out)
+
+
+def parse_tags(raw):
+    tags = {}
+    for item in raw.split(';'):
+        key, _, value = item.partition('=')
+        tags[key] = unescape_tag(value) if '\\' in value else value
+    return tags
+
+
+def parse_line(line, commands=None):
+    """
+    Parse an IRC line in a single left-to-right pass, without regexes.
+    If commands is given, lines whose command isn't in it are dropped (None
+    is returned) before their params are split.
+    """
+    raw_tags = ''
+    if line[:1] == '@':
+        raw_tags, _, line = line[1:].partition(' ')
+    prefix = ''
+    if line[:1] == ':':
+        prefix, _, line = line[1:].partition(' ')
+    command, _, rest = line.partition(' ')
+    if not command or (commands is not None and command not in commands):
+        return None
+
+    if rest.startswith(':'):
+        params = [rest[1:]]
+    else:
+        middle, sep, trailing = rest.partition(' :')
+        params = middle.split()
+        if sep:
+            params.append(trailing)
+    return Message(raw_tags, prefix, command, params)
+
+
+def parse_privmsg(line):
+    """
+    Parse line if it is a PRIVMSG, else return None.
+    """
+    return parse_line(line, PRIVMSG)
+
+
+class TokenBucket():
+    """
+    Allows up to <limit> sends per <period> seconds, in bursts of up to <limit>.
+    """
+    def __init__(self, limit, period):
+        self.capacity = limit
+        self.rate = limit / period
+        self.tokens = float(limit)
+        self.last = time.monotonic()
+
+    def wait(self, now):
+        """
+        Return how many seconds until a send is allowed (0 if it is now).
+        """
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class IRCConnection():
+    """
+    asyncio IRC transport. A reader task splits the server stream into lines
+    and puts them on the bounded inbound queue, and a writer task sends lines
+    from a bounded priority queue, so neither path waits on the code that
+    processes messages.
+
+    PINGs are answered by the reader task, by queueing the PONG ahead of all
+    other output. on_ping, if given, is called with each PING line after the
+    PONG is queued, and on_write with the number of lines and the seconds
+    taken after each write.
+
+    Lines sent to a channel are rate limited by a global token bucket of
+    global_limit = (messages, seconds) and one of channel_limit per channel.
+    A line that has to wait doesn't hold up lines for other channels or
+    commands. Everything that is ready goes out in a single write of up to
+    write_size bytes, and the transport buffers and delivers it in full.
+    """
+    def __init__(self, host, port, encoding='utf-8', queue_size=1024, read_limit=1 << 16,
+                 on_ping=None, global_limit=(20, 30), channel_limit=(1, 1), write_size=1 << 14,
+                 on_write=None):
+        self.host = host
+        self.port = port
+        self.encoding = encoding
+        self.read_limit = read_limit  # StreamReader buffer size, also the longest accepted line
+        self.inbound = asyncio.Queue(queue_size)
+        self.queue_size = queue_size
+        self.outbound = []  # heap of (priority, seq, channel, line)
+        self.seq = 0
+        self.wake = asyncio.Event()  # set when a line is queued
+        self.flushed = asyncio.Event()  # set while nothing is queued
+        self.flushed.set()
+        self.global_bucket = TokenBucket(*global_limit)
+        self.channel_limit = channel_limit
+        self.channel_buckets = {}
+        self.write_size = write_size
+        self.on_ping = on_ping
+        self.on_write = on_write
+        self.reader = None
+        self.writer = None
+        self.tasks = []
+        self.closed = asyncio.Event()
+        # counters
+        self.sent = 0
+        self.dropped = 0
+        self.writes = 0
+        self.max_depth = 0
+
+    def __len__(self):
+        return len(self.outbound)
+
+    async def open(self):
+        """
+        Open the connection and start the reader and writer tasks.
+        """
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port,
+                                                                 limit=self.read_limit)
+        self.tasks = [asyncio.create_task(self.read_loop(), name='irc-read'),
+                      asyncio.create_task(self.write_loop(), name='irc-write')]
+
+    async def read_loop(self):
+        while True:
+            try:
+                raw = await self.reader.readline()
+            except ValueError:
+                # line longer than read_limit; the reader has dropped it
+                continue
+            except (ConnectionError, OSError):
+                break
+            if not raw:
+                break
+            line = raw.decode(self.encoding, errors='replace').rstrip('\r\n')
+            if line.startswith('PING'):
+                self.send('PONG' + line[4:], PRIORITY_PONG)
+                if self.on_ping is not None:
+                    self.on_ping(line)
+                continue
+            await self.inbound.put(line)
+        self.closed.set()
+        await self.inbound.put(None)  # tell the consumer the stream has ended
+
+    def channel_bucket(self, channel):
+        bucket = self.channel_buckets.get(channel)
+        if bucket is None:
+            bucket = self.channel_buckets[channel] = TokenBucket(*self.channel_limit)
+        return bucket
+
+    def take_ready(self):
+        """
+        Pop the lines that may be sent now, in priority order, up to write_size
+        bytes. Returns (data, lines, delay), where delay is how long until a line
+        that had to wait may go (None if no line is waiting).
+        """
+        outbound = self.outbound
+        now = time.monotonic()
+        data = []
+        size = 0
+        held = []
+        delay = None
+        while outbound and size < self.write_size:
+            item = heapq.heappop(outbound)
+            channel = item[2]
+            if channel is not None:
+                wait = self.global_bucket.wait(now)
+                if wait:
+                    # no channel may send, and the rest of the queue is channel lines
+                    held.append(item)
+                    delay = wait if delay is None else min(delay, wait)
+                    break
+                bucket = self.channel_bucket(channel)
+                wait = bucket.wait(now)
+                if wait:
+                    held.append(item)
+                    delay = wait if delay is None else min(delay, wait)
+                    continue
+                self.global_bucket.take()
+                bucket.take()
+            line = (item[3] + '\r\n').encode(self.encoding)
+            data.append(line)
+            size += len(line)
+        for item in held:
+            heapq.heappush(outbound, item)
+        return b''.join(data), len(data), delay
+
+    async def write_loop(self):
+        while True:
+            await self.wake.wait()
+            data, n, delay = self.take_ready()
+            if data:
+                start = time.perf_counter()
+                self.writer.write(data)
+                await self.writer.drain()
+                self.sent += n
+                self.writes += 1
+                if self.on_write is not None:
+                    self.on_write(n, time.perf_counter() - start)
+            if not self.outbound:
+                self.wake.clear()
+                self.flushed.set()
+            elif not data:
+                # everything queued is rate limited; sleep until the first line may go
+                self.wake.clear()
+                try:
+                    await asyncio.wait_for(self.wake.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                self.wake.set()
+
+    def send(self, line, priority=PRIORITY_COMMAND, channel=None):
+        """
+        Queue a line to be sent, without waiting. Lines for a channel are rate
+        limited. Returns False if the queue is full and the line was dropped;
+        PONGs are never dropped.
+        """
+        if len(self.outbound) >= self.queue_size and priority != PRIORITY_PONG:
+            self.dropped += 1
+            return False
+        self.seq += 1
+        heapq.heappush(self.outbound, (priority, self.seq, channel, line))
+        self.max_depth = max(self.max_depth, len(self.outbound))
+        self.flushed.clear()
+        self.wake.set()
+        return True
+
+    def send_privmsg(self, channel, text):
+        """
+        Queue a chat message to channel (without the '#'). See send.
+        """
+        return self.send(f'PRIVMSG #{channel} :{text}', PRIORITY_MESSAGE, channel)
+
+    def summary(self):
+        return (f'send queue: {len(self.outbound)} queued (max {self.max_depth}), '
+                f'{self.sent} sent in {self.writes} writes, {self.dropped} dropped')
+
+    async def readline(self):
+        """
+        Return the next line from the server, or None once the connection has closed.
+        """
+        return await self.inbound.get()
+
+    async def close(self, timeout=5):
+        """
+        Flush queued output (for up to timeout seconds), then close the connection.
+        """
+        if self.writer is None:
+            return
+        if not self.closed.is_set():
+            try:
+                await asyncio.wait_for(self.flushed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except (ConnectionError, OSError):
+            pass
+        self.writer = None
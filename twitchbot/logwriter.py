@@ -0,0 +1,119 @@
+import json
+import os
+import threading
+import time
+
+LOG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'logs')
+
+
+class JsonLinesWriter():
+    """
+    Append-only writer of JSON Lines files (one JSON record per line).
+
+    Records are buffered in memory and written by a background thread every
+    flush_interval seconds, or sooner once flush_size bytes are buffered.
+    Files are named <prefix>-<date>-<n>.jsonl in directory, and a new one is
+    started each day and whenever the current one reaches max_bytes.
+    """
+    def __init__(self, prefix, directory=LOG_DIR, max_bytes=1 << 26, flush_interval=5.0,
+                 flush_size=1 << 16, encoding='utf-8'):
+        self.prefix = prefix
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.encoding = encoding
+        self.buffer = []
+        self.buffered = 0
+        self.lock = threading.Lock()  # guards buffer against the flush thread
+        self.wake = threading.Event()
+        self.running = False
+        self.thread = None
+        self.file = None
+        self.path = None
+        self.date = None
+        self.size = 0
+        self.records = 0
+
+    def write(self, record):
+        """
+        Buffer a record (a dict) to be written. Starts the flush thread on first use.
+        """
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+        with self.lock:
+            self.buffer.append(line)
+            self.buffered += len(line)
+            full = self.buffered >= self.flush_size
+        if not self.running:
+            self.start()
+        if full:
+            self.wake.set()
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name=f'{self.prefix}-log', daemon=True)
+        self.thread.start()
+
+    def close(self):
+        """
+        Stop the flush thread, write out the buffer and close the file.
+        """
+        self.running = False
+        self.wake.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def open_file(self, date):
+        """
+        Open the next file for date, after the ones already in directory.
+        """
+        if self.file is not None:
+            self.file.close()
+        os.makedirs(self.directory, exist_ok=True)
+        n = 0
+        while True:
+            path = os.path.join(self.directory, f'{self.prefix}-{date}-{n}.jsonl')
+            if not os.path.exists(path) or os.path.getsize(path) < self.max_bytes:
+                break
+            n += 1
+        self.file = open(path, 'a', encoding=self.encoding, newline='\n')
+        self.path = path
+        self.date = date
+        self.size = self.file.tell()
+
+    def flush(self):
+        """
+        Write all buffered records, rotating files as needed.
+        """
+        with self.lock:
+            lines, self.buffer = self.buffer, []
+            self.buffered = 0
+        if not lines:
+            return
+        date = time.strftime('%Y-%m-%d', time.localtime())
+        if self.file is None or date != self.date:
+            self.open_file(date)
+        start = 0
+        for i, line in enumerate(lines):
+            # approximate: sizes are counted in characters, not encoded bytes
+            if self.size >= self.max_bytes:
+                self.file.writelines(lines[start:i])
+                start = i
+                self.open_file(date)
+            self.size += len(line)
+        self.file.writelines(lines[start:])
+        self.file.flush()
+        self.records += len(lines)
+
+    def run(self):
+        while self.running:
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            self.flush()
@@ -1,240 +1,1361 @@
+import heapq
 import numpy as np
-import re
 import os
+import random
+import snapshot
+import sys
+import time
+import train
+from array import array
+from bisect import bisect_right
+from itertools import accumulate
 
+ID_BITS = 32  # bits used by each token id when packing a context into an int
+SEED_TRIES = 32  # keyword index entries tried when seeding a reply
+SCAN_LIMIT = 64  # keyword index entries scanned per backward step
+COMPACT_KEYS = 1 << 15  # contexts in row dicts before a running bot compacts them
 
-class MCBot():
 
-    def __init__(self):
-        self.word_list = [] # list of all words passed
-        self.word_dict = {} # dict of (w1, w2) -> w3 mappings
-        self.word_count = len(self.word_list)
-        self.special_char = 'SPECCHAR'
+class FenwickTree():
+    """
+    Append-only array of non-negative weights with O(log n) point updates,
+    prefix sums and weighted index lookup (a binary indexed tree). Built
+    from initial weights in O(n).
+    """
+    def __init__(self, weights=()):
+        tree = self.tree = array('Q', (0,))  # 1-based, tree[0] is unused
+        tree.extend(weights)
+        n = len(tree) - 1
+        for i in range(1, n + 1):
+            parent = i + (i & -i)
+            if parent <= n:
+                tree[parent] += tree[i]
+        self.total = self.prefix(n)
+
+    def __len__(self):
+        return len(self.tree) - 1
+
+    def prefix(self, i):
+        """
+        Return the sum of the first i weights.
+        """
+        tree = self.tree
+        s = 0
+        while i > 0:
+            s += tree[i]
+            i &= i - 1
+        return s
+
+    def append(self, weight):
+        tree = self.tree
+        i = len(tree)
+        # tree[i] covers (i - lowbit(i), i]: sum the nodes already covering the rest of it
+        stop = i - (i & -i)
+        node = weight
+        j = i - 1
+        while j > stop:
+            node += tree[j]
+            j &= j - 1
+        tree.append(node)
+        self.total += weight
+
+    def add(self, index, delta):
+        """
+        Add delta to the weight at (0-based) index.
+        """
+        tree = self.tree
+        n = len(tree)
+        i = index + 1
+        while i < n:
+            tree[i] += delta
+            i += i & -i
+        self.total += delta
+
+    def find(self, r):
+        """
+        Return the (0-based) index whose cumulative weight range contains r,
+        for 0 <= r < total.
+        """
+        tree = self.tree
+        n = len(tree) - 1
+        pos = 0
+        step = 1 << n.bit_length()
+        while step:
+            nxt = pos + step
+            if nxt <= n and tree[nxt] <= r:
+                pos = nxt
+                r -= tree[nxt]
+            step >>= 1
+        return pos
+
+
+class SeedReservoir():
+    """
+    Opening contexts of up to cap messages, stored flat as <order> token ids
+    each in one array('I'). Once full, each new message replaces a random
+    slot with probability cap / messages seen (reservoir sampling), so the
+    seeds stay a uniform sample of every message at a fixed size.
+    """
+    def __init__(self, order, cap):
+        if cap < 1:
+            raise ValueError('seed cap must be at least 1')
+        self.order = order
+        self.cap = cap
+        self.tokens = array('I')
+        self.seen = 0
+
+    def __len__(self):
+        return len(self.tokens) // self.order
+
+    def add(self, context):
+        n = len(self)
+        if n < self.cap:
+            self.tokens.extend(context)
+        else:
+            j = random.randrange(self.seen + 1)
+            if j < n:
+                self.tokens[j * self.order:(j + 1) * self.order] = array('I', context)
+        self.seen += 1
+
+    def sample(self):
+        """
+        Return the token ids of a random seed, or None if there are none.
+        """
+        n = len(self)
+        if n == 0:
+            return None
+        j = random.randrange(n) * self.order
+        return self.tokens[j:j + self.order]
+
+
+class MarkovModel():
+    """
+    Order-N markov chain. Every token is interned to an integer id, and each
+    context of N consecutive tokens is packed into a single int
+    (w1 << 32*(N-1) | ... | wN). Transitions are stored per context as a
+    row dict of successor id -> count, so a model holds each word string
+    exactly once no matter how many n-grams it appears in, and counting a
+    transition is a single lookup however many successors its context has.
+
+    For example, with order=2 'The dog barked loudly' is interned to
+    [0, 1, 2, 3] and stored as
+    key_index = {(0, 1): 0, (1, 2): 1} (packed), rows = [{2: 1}, {3: 1}]
+
+    Rows in dicts are quick to update but take a few hundred bytes per
+    context. compact() moves them into a read-only CSR segment in memory
+    (see MappedModel), which takes a few dozen bytes per context and 8 per
+    transition; train() does so once a file is counted.
+
+    Sentences start from a random key. With seed_cap, they start instead from
+    the opening words of a random past message, kept in a SeedReservoir of
+    at most seed_cap messages.
+
+    With keyword_index, word_keys maps each token id to the indices of the
+    keys whose n-grams contain it, so generate_reply can start from a given word.
+    """
+    backoff = False  # keys are tagged with their length, see BackoffModel
+
+    def __init__(self, order=1, seed_cap=None, keyword_index=False):
+        if order < 1:
+            raise ValueError('order must be at least 1')
+        self.order = order
+        self.mask = (1 << (ID_BITS * order)) - 1
+        self.vocab = {}  # word -> token id
+        self.words = []  # token id -> word
+        self.key_index = {}  # packed context -> key index
+        self.keys = []  # key index -> packed context
+        self.rows = []  # key index -> dict of successor token id -> count
+        self.cum = {}  # key index -> cached (successors, cumulative counts) arrays
+        self.totals = array('Q')  # key index -> total successor count
+        self.total = 0  # sum of totals
+        self.edges = 0  # (key, successor) transitions, kept for size
+        self.key_weights = None  # FenwickTree over totals, built on the first weighted pick
+        self.free = []  # key indices of removed keys, reused by new keys
+        self.free_words = []  # ids of released words, reused by new words
+        self.word_count = 0  # total tokens passed
+        self.saved_words = 0  # vocabulary size at the last save
+        self.dirty = None  # keys changed since the last save, tracked once saved or loaded
+        self.seed_cap = seed_cap
+        self.seeds = None if seed_cap is None else SeedReservoir(order, seed_cap)
+        self.word_keys = {} if keyword_index else None  # token id -> array('i') of key indices
+        self.index_size = 0  # entries in word_keys
+        self.index_stale = 0  # entries that may no longer hold, see unindex
+
+    def clear(self):
+        """
+        Reset the model to an untrained state.
+        """
+        MarkovModel.__init__(self, self.order, self.seed_cap, self.word_keys is not None)
 
-    def train(self, file_name=''):
+    def empty(self):
+        """
+        Return True if the model has no transitions to sample from.
+        """
+        return self.total == 0
+
+    def size(self):
+        """
+        Return the vocabulary size and number of context keys and transitions, in O(1).
+        """
+        return {'words': len(self.words) - len(self.free_words), 'keys': len(self.key_index),
+                'transitions': self.edges}
+
+    def stats(self):
+        """
+        Return size() and an estimate of the bytes held by the tables. Walks
+        every row, so it's meant for occasional reporting.
+        """
+        getsizeof = sys.getsizeof
+        nbytes = sum(getsizeof(t) for t in (self.vocab or {}, self.key_index, self.keys,
+                                            self.rows, self.cum, self.totals))
+        if self.key_weights is not None:
+            nbytes += getsizeof(self.key_weights.tree)
+        for key, row in zip(self.keys, self.rows):
+            nbytes += getsizeof(key) + getsizeof(row)
+        for succ, cum in self.cum.values():
+            nbytes += getsizeof(succ) + getsizeof(cum)
+        nbytes += self.words_size()
+        if self.seeds is not None:
+            nbytes += getsizeof(self.seeds.tokens)
+        return dict(self.size(), bytes=nbytes)
+
+    def largest_keys(self, n=20):
+        """
+        Return the n context keys with the most successors, as (context words, successors, total count).
+        """
+        rows = heapq.nlargest(n, self.iter_rows(), key=lambda row: len(row[1]))
+        return [(tuple(self.words[t] for t in self.unpack(key)), len(succ), sum(counts))
+                for key, succ, counts in rows]
+
+    def words_size(self):
+        """
+        Bytes held by the in-memory vocabulary strings.
+        """
+        return sys.getsizeof(self.words) + sum(sys.getsizeof(w) for w in self.words if w is not None)
+
+    def train(self, file_name='', workers=None, progress=train.print_progress):
         """
         Train the MC Bot on a text (txt, csv, etc.) located in the
-        /data directory. Updates the word list and word dict.
+        /data directory. Updates the vocabulary and transition tables.
+        The file is streamed in chunks and counted across <workers> processes,
+        see train.train_file.
         """
         if file_name == '':
-            self.word_dict = {}
-        else: # need to add try/except block here
-            dir = os.path.dirname(__file__)
-            rel_path = 'data\\' + file_name
-            abs_path = os.path.join(dir, rel_path)
-            with open(abs_path) as f:
-                words = f.read().split()
-            self.update_dict(words)
+            self.clear()
+        else:
+            abs_path = os.path.join(os.path.dirname(__file__), 'data', file_name)
+            train.train_file(self, abs_path, workers=workers, progress=progress)
+            self.compact()
+
+    def compact(self, min_keys=None):
+        """
+        Move every row into one read-only CSR segment in memory (see
+        snapshot.py) and turn the model into a MappedModel over it. A context
+        takes 16 bytes there plus its key and search copies of it, and a
+        transition 8, where a row dict takes a few hundred. Rows that change
+        later are copied back into dicts.
+
+        With min_keys, nothing is done while fewer than min_keys contexts are
+        in dicts, or they are fewer than an eighth of those already compacted,
+        so it can be called after every update: each context is compacted
+        O(1) times on average. Returns True if the model was compacted.
+        """
+        in_memory = len(self.key_index)
+        if in_memory == 0:
+            return False
+        if min_keys is not None and (in_memory < min_keys
+                                     or 8 * in_memory < self.size()['keys'] - in_memory):
+            return False
+        snap = snapshot.Snapshot.from_bytes(self.to_bytes())
+        keep = {name: getattr(self, name) for name in
+                ('vocab', 'free_words', 'seed_cap', 'seeds', 'word_count', 'saved_words',
+                 'dirty')}
+        keyword_index = self.word_keys is not None
+        self.__class__ = MappedBackoffModel if self.backoff else MappedModel
+        self.__class__.__init__(self, snap)
+        self.__dict__.update(keep)
+        if keyword_index:
+            self.enable_keyword_index()
+        return True
 
     def add_text(self, text):
         """
-        Adds a new string to the word list and word dict.
+        Adds a new string to the vocabulary and transition tables.
         """
-        new_text = text.split()
-        self.word_list.extend(new_text)
-        self.update_dict(new_text)
-        self.word_count = len(self.word_list)
-    # changing to version 1, simply copy and paste from before to restore
+        tokens = self.intern_words(text.split())
+        self.update_tokens(tokens)
+        self.add_seed(tokens)
+        self.word_count += len(tokens)
 
-    def update_dict(self, word_list):
+    def add_seed(self, tokens):
+        """
+        Keep the opening context of a message's token ids as a sentence seed, if seeds are kept.
+        """
+        if self.seeds is not None and len(tokens) > self.order:
+            self.seeds.add(tokens[:self.order])
+
+    def intern(self, word):
+        """
+        Return the token id of word, assigning a new one if it hasn't been seen.
+        """
+        token = self.vocab.get(word)
+        if token is None:
+            if self.free_words:
+                token = self.free_words.pop()
+                self.words[token] = word
+            else:
+                token = len(self.words)
+                self.words.append(word)
+            self.vocab[word] = token
+        return token
+
+    def intern_words(self, words):
+        """
+        Return the token ids of a list of words, interning the new ones.
+        """
+        tokens = list(map(self.vocab.get, words))
+        if None in tokens:
+            tokens = [self.intern(w) if t is None else t for w, t in zip(words, tokens)]
+        return tokens
+
+    def token(self, word):
+        """
+        Return the token id of word, or None if it hasn't been seen.
+        """
+        return self.vocab.get(word)
+
+    def release_word(self, token):
         """
-        Updates the word dict by taking in a list of words. The list is parsed
-        into sequences of 3.  The dict stores keys that are pairs of consecutive words
-        (w1, w2) and values that are the third consecutive word.
+        Forget the word with id token so the id can be reused. The caller must
+        make sure no transition refers to it any more. Ids aren't reused while
+        changes are tracked for delta snapshots, which only append words;
+        returns False in that case.
+        """
+        if self.dirty is not None:
+            return False
+        del self.vocab[self.words[token]]
+        self.words[token] = None
+        self.free_words.append(token)
+        return True
 
-        For example, 'The dog barked loudly' would be
-        parsed into (The, dog, barked) and (dog, barked, loudly), and stored as
-        {('The', 'dog'): {'barked': 1}, ('dog', 'barked'): {'loudly': 1}}
+    def pack(self, tokens):
+        """
+        Pack a sequence of <order> token ids into a context key.
         """
-        result = self.word_dict
-        for i in range(0, len(word_list) - 1):
-            w1 = word_list[i]
-            w2 = word_list[i + 1]
+        key = 0
+        for t in tokens:
+            key = (key << ID_BITS) | t
+        return key
 
+    def unpack(self, key):
+        """
+        Unpack a context key into a tuple of <order> token ids.
+        """
+        low = (1 << ID_BITS) - 1
+        return tuple((key >> (ID_BITS * i)) & low for i in range(self.order - 1, -1, -1))
 
-            if w1 not in result:
-                result[w1] = {w2: 1}
-            if w2 not in result[w1]:
-                result[w1][w2] = 1
+    def update_dict(self, word_list):
+        """
+        Updates the transition tables by taking in a list of words. The list is
+        parsed into sequences of order + 1 words: the first <order> words form
+        the context key and the last one is counted as its successor.
+        """
+        self.update_tokens(self.intern_words(word_list))
+
+    def update_tokens(self, tokens, remove=False):
+        """
+        Count every n-gram of a sequence of token ids, see update_dict. With
+        remove, the n-grams are subtracted again instead (see remove_transition).
+        """
+        order = self.order
+        if len(tokens) <= order:
+            return
+        update = self.remove_transition if remove else self.add_transition
+        key = self.pack(tokens[:order])
+        mask = self.mask
+        if (remove or self.free or self.dirty is not None or self.key_weights is not None
+                or self.word_keys is not None):
+            for t in tokens[order:]:
+                update(key, t)
+                key = ((key << ID_BITS) | t) & mask
+            return
+        # add_transition inlined, for when there's nothing to keep up to date but the counts
+        key_index, keys, rows, totals, cum = self.key_index, self.keys, self.rows, self.totals, self.cum
+        get = key_index.get
+        edges = 0
+        for t in tokens[order:]:
+            k = get(key)
+            if k is None:
+                key_index[key] = len(keys)
+                keys.append(key)
+                rows.append({t: 1})
+                totals.append(1)
+                edges += 1
             else:
-                result[w1][w2] = result[w1][w2] + 1
+                row = rows[k]
+                n = row.get(t)
+                if n is None:
+                    row[t] = 1
+                    edges += 1
+                else:
+                    row[t] = n + 1
+                totals[k] += 1
+                if cum:
+                    cum.pop(k, None)
+            key = ((key << ID_BITS) | t) & mask
+        self.edges += edges
+        self.total += len(tokens) - order
+
+    def new_key(self, key, row):
+        """
+        Store a context key that isn't present yet with the given row dict,
+        reusing the index of a removed key if there is one. Returns the key index.
+        """
+        total = sum(row.values())
+        if self.free:
+            k = self.free.pop()
+            self.keys[k] = key
+            self.rows[k] = row
+            self.add_weight(k, total)
+        else:
+            k = len(self.keys)
+            self.keys.append(key)
+            self.rows.append(row)
+            self.totals.append(total)
+            self.total += total
+            if self.key_weights is not None:
+                self.key_weights.append(total)
+        self.key_index[key] = k
+        self.edges += len(row)
+        if self.word_keys is not None:
+            self.index_tokens(k, set(self.unpack(key)).union(row))
+        return k
+
+    def remove_key(self, k):
+        """
+        Remove the key at index k. Its index is kept for reuse by the next new key.
+        """
+        key = self.keys[k]
+        del self.key_index[key]
+        self.add_weight(k, -self.totals[k])
+        self.edges -= len(self.rows[k])
+        stale = len(self.rows[k]) + self.order
+        self.keys[k] = None
+        self.rows[k] = {}
+        self.cum.pop(k, None)
+        self.free.append(k)
+        if self.dirty is not None:
+            self.dirty.add(key)
+        if self.word_keys is not None:
+            self.unindex(stale)
+
+    def set_row(self, key, succ, counts):
+        """
+        Replace all successors of the context key. An empty row removes the key.
+        """
+        k = self.key_index.get(key)
+        if k is not None:
+            if not len(succ):
+                self.remove_key(k)
+                return
+            row = dict(zip(succ, counts))
+            self.add_weight(k, sum(row.values()) - self.totals[k])
+            stale = len(self.rows[k])
+            self.edges += len(row) - stale
+            self.rows[k] = row
+            self.cum.pop(k, None)
+            if self.word_keys is not None:
+                self.index_tokens(k, row)
+                self.unindex(stale)
+        elif len(succ):
+            self.new_key(key, dict(zip(succ, counts)))
+        if self.dirty is not None:
+            self.dirty.add(key)
+
+    def add_row(self, key, succ, counts):
+        """
+        Add counts[i] to the count of successor succ[i] of the context key, for each i.
+        """
+        if self.key_index.get(key) is None:
+            self.new_key(key, dict(zip(succ, counts)))
+            if self.dirty is not None:
+                self.dirty.add(key)
+            return
+        for token, n in zip(succ, counts):
+            self.add_transition(key, token, n)
+
+    def add_weight(self, k, delta):
+        """
+        Add delta to the total count of the key at index k.
+        """
+        self.totals[k] += delta
+        self.total += delta
+        if self.key_weights is not None:
+            self.key_weights.add(k, delta)
+
+    def weights(self):
+        """
+        Return the key weight tree, building it from totals on first use.
+        Only models that pick weighted keys pay for keeping it up to date.
+        """
+        if self.key_weights is None:
+            self.key_weights = FenwickTree(self.totals)
+        return self.key_weights
+
+    def add_transition(self, key, token, n=1):
+        """
+        Add n to the count of token following the context key.
+        """
+        if self.dirty is not None:
+            self.dirty.add(key)
+        k = self.key_index.get(key)
+        if k is None:
+            self.new_key(key, {token: n})
+            return
+        row = self.rows[k]
+        count = row.get(token)
+        if count is None:
+            row[token] = n
+            self.edges += 1
+            if self.word_keys is not None:
+                self.index_token(token, k)
+        else:
+            row[token] = count + n
+        self.cum.pop(k, None)
+        self.add_weight(k, n)
+
+    def remove_transition(self, key, token, n=1):
+        """
+        Subtract n from the count of token following the context key. The
+        transition is removed when its count reaches zero, and the key when it
+        has no successors left.
+        """
+        k = self.key_index.get(key)
+        if k is None:
+            return
+        row = self.rows[k]
+        count = row.get(token)
+        if count is None:
+            return
+        if self.dirty is not None:
+            self.dirty.add(key)
+        if count > n:
+            row[token] = count - n
+        else:
+            if len(row) == 1:
+                self.remove_key(k)
+                return
+            n = count
+            del row[token]
+            self.edges -= 1
+            if self.word_keys is not None:
+                self.unindex(1)
+        self.cum.pop(k, None)
+        self.add_weight(k, -n)
+
+    def decay(self, factor):
+        """
+        Multiply every count by factor (0 < factor < 1), rounding randomly so
+        that counts shrink by factor on average. Transitions that reach zero
+        are removed, and keys left without successors with them. Only rows
+        whose counts change are rewritten.
+        """
+        rand = random.random
+        changes = []
+        for key, succ, counts in self.iter_rows():
+            new = [int(c * factor + rand()) for c in counts]
+            if new != list(counts):
+                changes.append((key, [t for t, c in zip(succ, new) if c], [c for c in new if c]))
+        for key, succ, counts in changes:
+            self.set_row(key, succ, counts)
+
+    def sample(self, k, u=None):
+        """
+        Return a random successor token id of the key at index k, weighted by count.
+        The cumulative count table of a key is built on first use and reused
+        until update_dict changes that key. Keys with a single successor skip it.
+        u is an optional uniform draw in [0, 1) to use instead of a fresh one.
+        """
+        row = self.rows[k]
+        if len(row) == 1:
+            return next(iter(row))
+        cached = self.cum.get(k)
+        if cached is None:
+            cached = self.cum[k] = (array('I', row), array('Q', accumulate(row.values())))
+        succ, cum = cached
+        if u is None:
+            u = random.random()
+        return succ[bisect_right(cum, u * cum[-1])]
+
+    def find(self, key):
+        """
+        Return the key index of a packed context key, or None if it isn't present.
+        """
+        return self.key_index.get(key)
+
+    def context(self, k):
+        """
+        Return the packed context key at key index k.
+        """
+        return self.keys[k]
+
+    def row(self, key):
+        """
+        Return the (successors, counts) of a packed context key as two parallel
+        sequences, empty if it isn't present.
+        """
+        k = self.key_index.get(key)
+        if k is None:
+            return (), ()
+        row = self.rows[k]
+        return row.keys(), row.values()
+
+    def count(self, key, token):
+        """
+        Return the count of token following the context key, 0 if it never has.
+        """
+        k = self.key_index.get(key)
+        return 0 if k is None else self.rows[k].get(token, 0)
+
+    def iter_rows(self):
+        """
+        Iterate over (key, successors, counts) for every context key, see row.
+        """
+        for key, row in zip(self.keys, self.rows):
+            if key is not None:
+                yield key, row.keys(), row.values()
 
     def next_word(self, key, alpha=.1):
-        """ Return a random word based on the current key (w1, w2)
-        If the word is not present, then return a random word from the word_dict.
-        If self.word_dict is empty, then return empty string.
+        """
+        Return a random successor token id of the context key.
+        If the key is not present, then sample from a random key instead.
+        Returns None if the walk should terminate.
 
         alpha is a tuning parameter that adjusts how often the bot will
-        terminate if a key is not found in the dict.
+        terminate if a key is not found in the tables.
         """
-        if self.word_dict == dict():
-            return ''
-        if key not in self.word_dict:
-            if np.random.uniform() < alpha:
-                return self.special_char
-            else:
-                key = self.random_key()
-        weights = np.array(list(self.word_dict[key].values()))
-        weight_proba = weights / sum(weights)
-        return np.random.choice(list(self.word_dict[key].keys()), p=weight_proba)
+        if self.empty():
+            return None
+        k = self.lookup(key, random.random(), alpha)
+        if k is None:
+            return None
+        return self.sample(k)
 
+    def lookup(self, key, u, alpha=.1):
+        """
+        Return the index of the key to sample the word after context key from,
+        or None if the walk should terminate: an unknown key terminates it if
+        u < alpha, and is otherwise replaced by a random key.
+        """
+        k = self.find(key)
+        if k is None:
+            if u < alpha:
+                return None
+            k = self.random_index()
+        return k
+
+    def advance(self, key, token):
+        """
+        Return the context key that follows key once token is appended.
+        """
+        return ((key << ID_BITS) | token) & self.mask
+
+    def random_index(self, weighted=False):
+        """
+        Return a random key index in O(1) by indexing the key list. If weighted,
+        keys are picked with probability proportional to how often they were
+        seen, in O(log n) via the key weight tree (see weights).
+        """
+        if weighted:
+            return self.weights().find(random.randrange(self.total))
+        keys = self.keys
+        while True:
+            k = random.randrange(len(keys))
+            if keys[k] is not None:
+                return k
 
-    def random_key(self):
+    def random_key(self, weighted=False):
         """
-        Assumes that word_dict.keys() contains keys, and convert to list.
-        This is necessary since np.random.choice cannot select from a list of tuples
-        The other solution is to use random.choice, but that requires storing actual word values rather than counts.
+        Return a random context key, see random_index.
         """
-        key_list = list(self.word_dict.keys())
-        rand_index = np.random.choice(len(key_list))
-        return key_list[rand_index]
+        return self.context(self.random_index(weighted))
 
-    def generate_sentence(self, word_limit=20, cap_first=True, end_punc='.'):
+    def random_seed(self, weighted=False):
+        """
+        Return a context key to start a sentence from: a random message opening
+        if seeds are kept and the picked one is still in the model, else random_key.
+        """
+        if self.seeds is not None:
+            context = self.seeds.sample()
+            if context is not None:
+                key = self.pack(context)
+                if self.find(key) is not None:
+                    return key
+        return self.random_key(weighted)
+
+    def enable_keyword_index(self):
+        """
+        Build word_keys from the current tables; it's kept up to date from then on.
+        Entries aren't removed when a key or successor goes away, they are
+        checked when used instead (see indexed), and the index is rebuilt
+        once most of it may be stale.
+        """
+        self.word_keys = {}
+        self.index_size = 0
+        self.index_stale = 0
+        unpack = self.unpack
+        for key, succ, counts in self.iter_rows():
+            self.index_tokens(self.find(key), set(unpack(key)).union(succ))
+
+    def index_tokens(self, k, tokens):
+        word_keys = self.word_keys
+        for t in tokens:
+            keys = word_keys.get(t)
+            if keys is None:
+                keys = word_keys[t] = array('i')
+            keys.append(k)
+        self.index_size += len(tokens)
+
+    def index_token(self, token, k):
+        self.index_tokens(k, (token,))
+
+    def unindex(self, n):
+        """
+        Count n index entries that may have gone stale, rebuilding the index
+        when they make up more than half of it.
+        """
+        self.index_stale += n
+        if self.index_stale > 1024 and self.index_stale * 2 > self.index_size:
+            self.enable_keyword_index()
+
+    def indexed(self, token, k):
+        """
+        Return the packed context key at index k if token is still in its
+        context or successors, else None.
+        """
+        key = self.context(k)
+        if key is None or self.find(key) != k:
+            return None
+        if token in self.unpack(key) or self.count(key, token):
+            return key
+        return None
+
+    def keyword_seed(self, token):
+        """
+        Return a context key to start a reply containing token from: a random
+        key whose context contains it, or the context that follows a key it
+        succeeds. Returns None if no live index entry is found.
+        """
+        keys = self.word_keys.get(token)
+        if not keys:
+            return None
+        for _ in range(SEED_TRIES):
+            k = keys[random.randrange(len(keys))]
+            key = self.indexed(token, k)
+            if key is not None:
+                return key if token in self.unpack(key) else self.advance(key, token)
+        return None
+
+    def previous_word(self, context):
+        """
+        Return a random token id seen before the context (a tuple of token ids),
+        weighted by how often it was, or None if none is found. Predecessors
+        are looked up through the index of the rarest token in context, and
+        at most SCAN_LIMIT of its entries are tried.
+        """
+        word_keys = self.word_keys
+        keys = min((word_keys.get(t, ()) for t in set(context)), key=len)
+        if len(keys) > SCAN_LIMIT:
+            keys = [keys[random.randrange(len(keys))] for _ in range(SCAN_LIMIT)]
+        head, last = context[:-1], context[-1]
+        tokens = []
+        weights = []
+        for k in keys:
+            key = self.context(k)
+            if key is None or self.find(key) != k:
+                continue
+            prev = self.unpack(key)
+            if len(prev) != len(context) or prev[1:] != head:
+                continue
+            n = self.count(key, last)
+            if n:
+                tokens.append(prev[0])
+                weights.append(n)
+        if not tokens:
+            return None
+        return random.choices(tokens, weights)[0]
+
+    def extend_sentence(self, key, sentence, word_limit, stop_chars, alpha):
+        """
+        Append words to sentence by walking forward from the context key.
+        """
+        while len(sentence) <= word_limit:
+            token = self.next_word(key, alpha)
+            if token is None:
+                break
+            word = self.words[token]
+            sentence.append(word)
+            if word[-1] in stop_chars and random.random() < .5:
+                break
+            key = self.advance(key, token)
+        return sentence
+
+    def generate_sentence(self, word_limit=20, cap_first=True, end_punc='.', alpha=.1,
+                          weighted_seed=False):
         """
         cap_first capitalizes the first word of the sentence, while end_punc allows
         customization of a punctuation mark to be added to the end of each sentence.
+        weighted_seed starts the sentence from a frequency-weighted key rather
+        than a uniformly random one.
         """
-        if self.word_dict == {}:
+        if self.empty():
             print('Error: The bot hasn\'t been trained yet.')
             return ''
-        punc = {'.', '?', '!', ';', ':', ',', end_punc}
-        sentence = []
+        stop_chars = {'.', '?', '!', end_punc}
 
-        seed = np.random.randint(0, len(self.word_list))
-        curr = self.word_list[seed]
-        if cap_first:
-            sentence.append(curr.capitalize())
-        else:
-            sentence.append(curr)
+        key = self.random_seed(weighted_seed)
+        sentence = [self.words[t] for t in self.unpack(key)]
+        self.extend_sentence(key, sentence, word_limit, stop_chars, alpha)
+        return self.join_sentence(sentence, cap_first, end_punc)
 
-        while len(sentence) <= word_limit:
-            curr = self.next_word(curr)
-            if curr == self.special_char:
+    def generate_reply(self, words, word_limit=20, cap_first=True, end_punc='.', alpha=.1):
+        """
+        Generate a sentence containing one of words, for replying to a message.
+        The rarest of the words the model knows is picked, since it says the
+        most about the message, and the sentence is grown backward and then
+        forward from an n-gram holding it. Needs the keyword index; without it,
+        or if none of the words are known, this is generate_sentence.
+        """
+        if self.word_keys is None or self.empty():
+            return self.generate_sentence(word_limit, cap_first, end_punc, alpha)
+        stop_chars = {'.', '?', '!', end_punc}
+        word_keys = self.word_keys
+        tokens = {t for t in map(self.token, words) if t is not None and word_keys.get(t)}
+        key = None
+        for token in sorted(tokens, key=lambda t: len(word_keys[t])):
+            key = self.keyword_seed(token)
+            if key is not None:
                 break
-            else:
-                sentence.append(curr)
+        if key is None:
+            return self.generate_sentence(word_limit, cap_first, end_punc, alpha)
+
+        context = self.unpack(key)
+        before = []
+        while len(before) + len(context) < word_limit // 2 and random.random() >= alpha:
+            token = self.previous_word(context)
+            if token is None or self.words[token][-1] in stop_chars:
+                break
+            before.append(token)
+            context = (token,) + context[:-1]
+        sentence = [self.words[t] for t in reversed(before)]
+        sentence.extend(self.words[t] for t in self.unpack(key))
+        self.extend_sentence(key, sentence, word_limit, stop_chars, alpha)
+        return self.join_sentence(sentence, cap_first, end_punc)
+
+    def generate_sentences(self, n, word_limit=20, cap_first=True, end_punc='.', alpha=.1,
+                           weighted_seed=False):
+        """
+        Generate n sentences at once, with the same options as generate_sentence.
+        All walks advance in lockstep: the random numbers for every active walk
+        in a step are drawn with a single NumPy call, and finished walks drop out.
+        """
+        if self.empty():
+            print('Error: The bot hasn\'t been trained yet.')
+            return []
+        stop_chars = {'.', '?', '!', end_punc}
+        words = self.words
+
+        keys = [self.random_seed(weighted_seed) for _ in range(n)]
+        sentences = [[words[t] for t in self.unpack(key)] for key in keys]
+        active = list(range(n))
+        length = self.order
+        while active and length <= word_limit:
+            # columns: unknown-key termination, successor, stop-char break
+            draws = np.random.random((len(active), 3)).tolist()
+            still_active = []
+            for i, (u_alpha, u_next, u_stop) in zip(active, draws):
+                k = self.lookup(keys[i], u_alpha, alpha)
+                if k is None:
+                    continue
+                token = self.sample(k, u_next)
+                word = words[token]
+                sentences[i].append(word)
+                if word[-1] in stop_chars and u_stop < .5:
+                    continue
+                keys[i] = self.advance(keys[i], token)
+                still_active.append(i)
+            active = still_active
+            length += 1
+        return [self.join_sentence(sentence, cap_first, end_punc) for sentence in sentences]
+
+    @staticmethod
+    def join_sentence(sentence, cap_first=True, end_punc='.'):
+        """
+        Join a list of words into a sentence, capitalizing the first word and
+        appending end_punc unless the sentence already ends in punctuation.
+        """
+        punc = {'.', '?', '!', ';', ':', ',', end_punc}
+        if cap_first:
+            sentence[0] = sentence[0].capitalize()
         result = ' '.join(sentence)
         if end_punc != '' and result[-1] not in punc:
             result += end_punc
         return result
 
+    def unused_words(self):
+        """
+        Return the ids of the words that no context, successor or seed refers
+        to any more, which can be released. Walks the whole model.
+        """
+        used = set()
+        unpack = self.unpack
+        for key, succ, counts in self.iter_rows():
+            used.update(unpack(key))
+            used.update(succ)
+        if self.seeds is not None:
+            used.update(self.seeds.tokens)
+        return [t for t, word in enumerate(self.words) if word and t not in used]
+
+    def prune(self, is_banned):
+        """
+        Remove, in place, every transition whose context or successor is a word
+        for which is_banned(word) is true. Returns the number of transitions removed.
+        """
+        banned = {t for t, word in enumerate(self.words) if word and is_banned(word)}
+        if not banned:
+            return 0
+        changes = []
+        removed = 0
+        for key, succ, counts in self.iter_rows():
+            if not banned.isdisjoint(self.unpack(key)):
+                changes.append((key, (), ()))
+                removed += len(succ)
+            elif not banned.isdisjoint(succ):
+                keep = [(t, c) for t, c in zip(succ, counts) if t not in banned]
+                changes.append((key, [t for t, _ in keep], [c for _, c in keep]))
+                removed += len(succ) - len(keep)
+        for key, succ, counts in changes:
+            self.set_row(key, succ, counts)
+        return removed
+
+    def to_bytes(self):
+        """
+        Return the model as a full snapshot, in bytes.
+        """
+        # released word ids are saved as empty words, keeping later ids in place
+        words = [w if w is not None else '' for w in self.words]
+        return snapshot.snapshot_bytes(self.order, words, self.iter_rows(), self.backoff)
+
+    def save(self, path, delta=False, track=True):
+        """
+        Save the model to a binary snapshot at path (see snapshot.py).
+
+        With delta, append only the words and rows that changed since the last
+        save or load of the same file, instead of rewriting the whole model.
+        Saving starts tracking changes for the next delta, which costs some
+        update speed and keeps word ids from being reused; with track=False
+        the model is left as it was, for one-off copies such as checkpoints.
+        """
+        if delta:
+            if self.dirty is None:
+                raise ValueError('delta snapshots need a full save or load first')
+            rows = [(key,) + self.row(key) for key in self.dirty]
+            snapshot.append_delta(path, self.order, self.saved_words,
+                                  self.words[self.saved_words:], rows, self.backoff)
+        else:
+            # released word ids are saved as empty words, keeping later ids in place
+            words = [w if w is not None else '' for w in self.words]
+            snapshot.write_snapshot(path, self.order, words, self.iter_rows(), self.backoff)
+        if track:
+            self.saved_words = len(self.words)
+            self.dirty = set()
+
+    @classmethod
+    def load(cls, path, mmap=True, track=True):
+        """
+        Load a model saved with save, including any appended deltas.
+
+        With mmap, the snapshot's base is memory-mapped and used in place
+        (see MappedModel), so loading takes constant time and processes that
+        load the same file share its pages. Otherwise it is read into a
+        regular in-memory model. A backoff model's snapshot loads as a
+        backoff model, whichever class this is called on. track starts
+        tracking changes for delta saves to path, as in save.
+        """
+        snap = snapshot.Snapshot(path, mmap)
+        if mmap:
+            model = (MappedBackoffModel if snap.backoff else MappedModel)(snap)
+        else:
+            model = (BackoffModel if snap.backoff else MarkovModel)(snap.order)
+            model.load_segment(snap.base)
+        for segment in snap.deltas:
+            model.load_segment(segment)
+        if not (mmap or track):
+            # released ids are saved as empty words, so they can be reused again
+            model.free_words = [i for i, w in enumerate(model.words) if not w]
+        if track:
+            model.saved_words = len(model.words)
+            model.dirty = set()
+        return model
+
+    def load_segment(self, segment):
+        """
+        Merge a snapshot segment: add its words, then replace its rows.
+        """
+        if segment.first_word != len(self.words):
+            raise ValueError('snapshot vocabulary is out of sequence')
+        for word in segment.all_words():
+            if word and self.vocab is not None:
+                self.vocab[word] = len(self.words)
+            self.words.append(word)
+        for key, succ, counts in segment.rows():
+            self.set_row(key, succ, counts)
 
-class MCBot2():
+
+class BackoffModel(MarkovModel):
     """
-    MCBot2 is uses an order-2 markov chain. This is not good OOP design, but it's functional
-    for now.
+    Markov chain over every context length from 0 to order, in one set of
+    tables. Keys are tagged with their length, n << 32*order | w1 << 32*(n-1)
+    | ... | wn, so the contexts of all orders share one key index, vocabulary
+    and key weight tree, and each message is counted into all of them in a
+    single pass. The empty context (key 0) counts every token.
+
+    Generation backs off from the longest context to shorter ones until it
+    finds one that has been seen with a successor, so it never has to jump
+    to a random key. In snapshots, each key takes an extra 4 bytes for its
+    length tag.
     """
-    def __init__(self):
-        self.word_list = [] # list of all words passed
-        self.word_dict = {} # dict of (w1, w2) -> w3 mappings
-        self.word_count = len(self.word_list)
+    backoff = True
+
+    def __init__(self, order=1, seed_cap=None, keyword_index=False):
+        super().__init__(order, seed_cap, keyword_index)
+        self.tag_shift = ID_BITS * order
+        self.low_masks = [(1 << (ID_BITS * n)) - 1 for n in range(order + 1)]
+
+    def pack(self, tokens):
+        key = 0
+        for t in tokens:
+            key = (key << ID_BITS) | t
+        return (len(tokens) << self.tag_shift) | key
+
+    def unpack(self, key):
+        low = (1 << ID_BITS) - 1
+        n = key >> self.tag_shift
+        return tuple((key >> (ID_BITS * i)) & low for i in range(n - 1, -1, -1))
 
-    def train(self, file_name=''):
+    def update_tokens(self, tokens, remove=False, start=0):
         """
-        Train the MC Bot on a text (txt, csv, etc.) located in the
-        /data directory. Updates the word list and word dict.
+        Count every token after each of its contexts of length 0 to order.
+        Tokens before start are only used as context.
         """
-        if file_name == '':
-            self.word_dict = {}
-        else: # need to add try/except block here
-            dir = os.path.dirname(__file__)
-            rel_path = 'data\\' + file_name
-            abs_path = os.path.join(dir, rel_path)
-            with open(abs_path) as f:
-                words = f.read().split()
-            self.update_dict(words)
+        update = self.remove_transition if remove else self.add_transition
+        order, shift, low_masks, mask = self.order, self.tag_shift, self.low_masks, self.mask
+        context = 0  # the last <order> tokens, packed
+        for i, t in enumerate(tokens):
+            if i >= start:
+                for n in range(min(i, order) + 1):
+                    update((n << shift) | (context & low_masks[n]), t)
+            context = ((context << ID_BITS) | t) & mask
 
-    def add_text(self, text):
+    def lookup(self, key, u, alpha=.1):
         """
-        Adds a new string to the word list and word dict.
+        Return the index of the longest suffix of context key that has been
+        seen, or None if the walk should terminate: it terminates if u < alpha
+        when key itself is unknown, or if there's nothing to back off to.
         """
-        new_text = text.split()
-        self.word_list.extend(new_text)
-        self.update_dict(new_text)
+        k = self.find(key)
+        if k is None and u < alpha:
+            return None
+        n = key >> self.tag_shift
+        while k is None and n > 0:
+            n -= 1
+            key = (n << self.tag_shift) | (key & self.low_masks[n])
+            k = self.find(key)
+        return k
 
-    def update_dict(self, word_list):
+    def advance(self, key, token):
+        n = min((key >> self.tag_shift) + 1, self.order)
+        return (n << self.tag_shift) | (((key << ID_BITS) | token) & self.low_masks[n])
+
+    def train(self, file_name='', workers=None, progress=train.print_progress):
         """
-        Updates the word dict by taking in a list of words. The list is parsed
-        into sequences of 3.  The dict stores keys that are pairs of consecutive words
-        (w1, w2) and values that are the third consecutive word.
-
-        For example, 'The dog barked loudly' would be
-        parsed into (The, dog, barked) and (dog, barked, loudly), and stored as
-        {('The', 'dog'): {'barked': 1}, ('dog', 'barked'): {'loudly': 1}}
-        """
-        result = self.word_dict
-        for i in range(0, len(word_list) - 2):
-            w1 = word_list[i]
-            w2 = word_list[i + 1]
-            key = (w1, w2)
-            value = word_list[i + 2]
-
-            if key not in result:
-                result[key] = {value: 1}
-            if value not in result[key]:
-                result[key][value] = 1
-            else:
-                result[key][value] = result[key][value] + 1
+        Train on a text in the /data directory, see MarkovModel.train. The
+        file is streamed in chunks but counted in this process, as the
+        multi-process trainer only counts a single order.
+        """
+        if file_name == '':
+            self.clear()
+            return
+        path = os.path.join(os.path.dirname(__file__), 'data', file_name)
+        total = os.path.getsize(path)
+        done = 0
+        carry = []  # last <order> tokens, the context of the next chunk's first tokens
+        start = time.perf_counter()
+        with open(path, 'rb') as f:
+            for size, text in train.iter_chunks(f, 1 << 22):
+                tokens = carry + self.intern_words(text.split())
+                self.update_tokens(tokens, start=len(carry))
+                self.word_count += len(tokens) - len(carry)
+                carry = tokens[-self.order:]
+                done += size
+                if progress is not None:
+                    progress(done, total, time.perf_counter() - start)
+        self.compact()
 
-    def next_word(self, key, alpha=.1):
-        """ Return a random word based on the current key (w1, w2)
-        If the word is not present, then return a random word from the word_dict.
-        If self.word_dict is empty, then return empty string.
 
-        alpha is a tuning parameter that adjusts how often the bot will
-        terminate if a key is not found in the dict.
+class MappedWords():
+    """
+    Token id -> word sequence over a snapshot segment's vocabulary, decoding
+    words on access, with in-memory words appended after it. Mapped words
+    that are released or reused are overridden in replaced.
+    """
+    def __init__(self, segment):
+        self.segment = segment
+        self.n_base = segment.n_words
+        self.extra = []
+        self.replaced = {}  # mapped id -> word that replaces it (None if released)
+
+    def __len__(self):
+        return self.n_base + len(self.extra)
+
+    def __iter__(self):
+        replaced = self.replaced
+        for i in range(self.n_base):
+            yield replaced[i] if i in replaced else self.segment.word(i)
+        yield from self.extra
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if i < self.n_base:
+            replaced = self.replaced
+            return replaced[i] if i in replaced else self.segment.word(i)
+        return self.extra[i - self.n_base]
+
+    def __setitem__(self, i, word):
+        if i < self.n_base:
+            self.replaced[i] = word
+        else:
+            self.extra[i - self.n_base] = word
+
+    def append(self, word):
+        self.extra.append(word)
+
+
+class MappedModel(MarkovModel):
+    """
+    MarkovModel backed by a memory-mapped snapshot. The snapshot's base
+    segment is used in place and never modified; rows that change after
+    loading are copied into the in-memory tables (copy-on-write) and shadow
+    the mapped ones. Mapped rows have negative key indices: row i is ~i.
+
+    The word -> id dict is only built on the first update, so a model that
+    is only used for generation never decodes its vocabulary.
+    """
+    def __init__(self, snap):
+        super().__init__(snap.order)
+        self.snapshot = snap
+        self.base = snap.base
+        self.words = MappedWords(self.base)
+        self.vocab = None
+        self.shadowed = set()  # base rows overridden by in-memory rows
+        self.shadowed_edges = 0  # transitions in the shadowed rows
+        self.base_cum = {}  # base row -> cached cumulative counts
+
+    def clear(self):
+        # nothing is left to map once cleared, so fall back to a plain model
+        self.__class__ = MarkovModel
+        MarkovModel.clear(self)
+
+    def empty(self):
+        return self.total == 0 and len(self.shadowed) == self.base.n_keys
+
+    def load_vocab(self):
+        if self.vocab is None:
+            vocab = self.vocab = {}
+            for i, w in enumerate(self.words):
+                if w:
+                    vocab[w] = i
+                elif self.dirty is None:
+                    # a word released before the snapshot was saved
+                    self.free_words.append(i)
+
+    def intern(self, word):
+        self.load_vocab()
+        return super().intern(word)
+
+    def intern_words(self, words):
+        self.load_vocab()
+        return super().intern_words(words)
+
+    def token(self, word):
+        self.load_vocab()
+        return super().token(word)
+
+    def release_word(self, token):
+        self.load_vocab()
+        return super().release_word(token)
+
+    def size(self):
+        size = super().size()
+        size['keys'] += self.base.n_keys - len(self.shadowed)
+        size['transitions'] += self.base.n_edges - self.shadowed_edges
+        return size
+
+    def stats(self):
+        return dict(super().stats(), mapped_bytes=self.base.end)
+
+    def words_size(self):
+        extra, replaced = self.words.extra, self.words.replaced
+        return (sys.getsizeof(extra) + sum(sys.getsizeof(w) for w in extra if w is not None)
+                + sys.getsizeof(replaced)
+                + sum(sys.getsizeof(w) for w in replaced.values() if w is not None))
+
+    def base_row(self, key):
         """
-        if self.word_dict == dict():
-            return ''
-        if key not in self.word_dict:
-            if np.random.uniform() < alpha:
-                return self.special_char
-            else:
-                key = self.random_key()
-        weights = np.array(list(self.word_dict[key].values()))
-        weight_proba = weights / sum(weights)
-        return np.random.choice(list(self.word_dict[key].keys()), p=weight_proba)
+        Return the base row index of key if it isn't shadowed, else None.
+        """
+        i = self.base.find(key)
+        if i is None or i in self.shadowed:
+            return None
+        return i
+
+    def find(self, key):
+        k = self.key_index.get(key)
+        if k is not None:
+            return k
+        i = self.base_row(key)
+        return None if i is None else ~i
 
+    def context(self, k):
+        return self.keys[k] if k >= 0 else self.base.key(~k)
 
-    def random_key(self):
+    def row(self, key):
+        i = None if key in self.key_index else self.base_row(key)
+        if i is not None:
+            return self.base.row(i)
+        return super().row(key)
+
+    def count(self, key, token):
+        i = None if key in self.key_index else self.base_row(key)
+        if i is None:
+            return super().count(key, token)
+        succ, counts = self.base.row(i)
+        succ = succ.tolist()
+        return counts[succ.index(token)] if token in succ else 0
+
+    def iter_rows(self):
+        shadowed = self.shadowed
+        for i, (key, succ, counts) in enumerate(self.base.rows()):
+            if i not in shadowed:
+                yield key, succ, counts
+        yield from super().iter_rows()
+
+    def shadow(self, key):
         """
-        Assumes that word_dict.keys() contains keys, and convert to list.
-        This is necessary since np.random.choice cannot select from a list of tuples
-        The other solution is to use random.choice, but that requires storing actual word values rather than counts.
+        Mark the base row of key as overridden by the in-memory tables.
+        Returns the base row index, or None if key has no live base row.
         """
-        key_list = list(self.word_dict.keys())
-        rand_index = np.random.choice(len(key_list))
-        return key_list[rand_index]
+        if key in self.key_index:
+            return None
+        i = self.base_row(key)
+        if i is not None:
+            self.shadowed.add(i)
+            self.shadowed_edges += len(self.base.row(i)[0])
+            self.base_cum.pop(i, None)
+        return i
 
-    def generate_sentence(self, word_limit=20, cap_first=True, end_punc='.'):
+    def copy_on_write(self, key):
         """
-        cap_first capitalizes the first word of the sentence, while end_punc allows
-        customization of a punctuation mark to be added to the end of each sentence.
+        Before key changes, move its mapped row (if any) into the in-memory tables.
         """
-        if self.word_dict == {}:
-            print('Error: The bot hasn\'t been trained yet.')
-            return ''
-        punc = {'.', '?', '!', ';', ':', ',', end_punc}
-        stop_chars = {'.', '?', '!', end_punc}
-        sentence = []
+        i = self.shadow(key)
+        if i is not None:
+            succ, counts = self.base.row(i)
+            self.new_key(key, dict(zip(succ, counts)))
 
-        curr, next = self.random_key()
-        if cap_first:
-            sentence.append(curr.capitalize())
-        else:
-            sentence.append(curr)
-        sentence.append(next)
+    def to_bytes(self):
+        rows = MarkovModel.iter_rows(self)
+        if self.words.replaced:
+            # mapped words were released or reused, so the vocabulary is written anew
+            words = [w if w is not None else '' for w in self.words]
+            return snapshot.merged_bytes(self.base, self.shadowed, words, rows, all_words=True)
+        words = [w if w is not None else '' for w in self.words.extra]
+        return snapshot.merged_bytes(self.base, self.shadowed, words, rows)
 
-        while len(sentence) <= word_limit:
-            key = (curr, next)
-            curr, next = next, self.next_word(key)
-            sentence.append(next)
-            if next[-1] in stop_chars:
-                if np.random.uniform() < .5:
-                    break
+    def update_tokens(self, tokens, remove=False):
+        # copy the mapped rows first, so that the counting loop only sees key_index
+        order, mask, key_index, find = self.order, self.mask, self.key_index, self.base.find
+        if len(tokens) > order:
+            key = self.pack(tokens[:order])
+            for t in tokens[order:]:
+                if key not in key_index and find(key) is not None:
+                    self.copy_on_write(key)
+                key = ((key << ID_BITS) | t) & mask
+        super().update_tokens(tokens, remove)
 
-        result = ' '.join(sentence)
-        if end_punc != '' and result[-1] not in punc:
-            result += end_punc
-        return result
+    def add_transition(self, key, token, n=1):
+        if key not in self.key_index:
+            self.copy_on_write(key)
+        super().add_transition(key, token, n)
+
+    def add_row(self, key, succ, counts):
+        self.copy_on_write(key)
+        super().add_row(key, succ, counts)
+
+    def remove_transition(self, key, token, n=1):
+        self.copy_on_write(key)
+        super().remove_transition(key, token, n)
+
+    def set_row(self, key, succ, counts):
+        self.shadow(key)
+        super().set_row(key, succ, counts)
+
+    def sample(self, k, u=None):
+        if k >= 0:
+            return super().sample(k, u)
+        i = ~k
+        succ, counts = self.base.row(i)
+        if len(succ) == 1:
+            return succ[0]
+        cum = self.base_cum.get(i)
+        if cum is None:
+            cum = self.base_cum[i] = array('Q', accumulate(counts))
+        if u is None:
+            u = random.random()
+        return succ[bisect_right(cum, u * cum[-1])]
+
+    def random_index(self, weighted=False):
+        # base rows that are shadowed are rejected and redrawn
+        base, shadowed = self.base, self.shadowed
+        if weighted:
+            base_total = base.total
+            while True:
+                r = random.randrange(base_total + self.total)
+                if r >= base_total:
+                    return self.weights().find(r - base_total)
+                i = base.weighted_row(r)
+                if i not in shadowed:
+                    return ~i
+        keys = self.keys
+        while True:
+            j = random.randrange(base.n_keys + len(keys))
+            if j < base.n_keys:
+                if j not in shadowed:
+                    return ~j
+            elif keys[j - base.n_keys] is not None:
+                return j - base.n_keys
+
+
+class MappedBackoffModel(MappedModel, BackoffModel):
+    """
+    BackoffModel backed by a memory-mapped snapshot, see MappedModel.
+    """
+    # every context length is counted through add_transition, which copies mapped rows on write
+    update_tokens = BackoffModel.update_tokens
 
+    def clear(self):
+        self.__class__ = BackoffModel
+        BackoffModel.clear(self)
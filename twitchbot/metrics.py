@@ -0,0 +1,184 @@
+"""
+Counters, latency histograms and gauges, rendered in the Prometheus text
+exposition format and served over HTTP by MetricsServer.
+"""
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# seconds, from 1 microsecond to 1 second
+LATENCY_BUCKETS = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3,
+                   5e-3, 1e-2, 2.5e-2, 5e-2, .1, .25, .5, 1.0)
+
+
+def format_seconds(seconds):
+    if seconds < 1e-3:
+        return f'{seconds * 1e6:.1f} us'
+    if seconds < 1:
+        return f'{seconds * 1e3:.1f} ms'
+    return f'{seconds:.2f} s'
+
+
+class Counter():
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def render(self):
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter',
+                f'{self.name} {self.value}']
+
+    def summary(self):
+        return f'{self.value:,}'
+
+
+class Histogram():
+    """
+    Counts observations (seconds) into fixed buckets; each bucket counts the
+    values up to its upper bound that aren't in a lower bucket.
+    """
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """
+        Upper bound of the bucket holding the q-th quantile (inf if it's past the last bucket).
+        """
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            lines.append(f'{self.name}_bucket{{le="{bound:g}"}} {seen}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f'{self.name}_sum {self.sum}')
+        lines.append(f'{self.name}_count {self.count}')
+        return lines
+
+    def summary(self):
+        if not self.count:
+            return '0 calls'
+        return (f'{self.count:,} calls, mean {format_seconds(self.sum / self.count)}, '
+                f'p99 <= {format_seconds(self.quantile(.99))}')
+
+
+class Gauge():
+    """
+    A value read from fn when the metrics are rendered.
+    """
+    def __init__(self, name, help, fn):
+        self.name = name
+        self.help = help
+        self.fn = fn
+
+    def render(self):
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} gauge',
+                f'{self.name} {self.fn()}']
+
+    def summary(self):
+        value = self.fn()
+        return f'{value:,}' if isinstance(value, int) else f'{value:g}'
+
+
+class Registry():
+    """
+    An ordered set of metrics, named <prefix>_<name>.
+    """
+    def __init__(self, prefix='mcbot'):
+        self.prefix = prefix
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help):
+        return self.add(Counter(f'{self.prefix}_{name}', help))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        return self.add(Histogram(f'{self.prefix}_{name}', help, buckets))
+
+    def gauge(self, name, help, fn):
+        return self.add(Gauge(f'{self.prefix}_{name}', help, fn))
+
+    def render(self):
+        """
+        Return every metric in the Prometheus text exposition format.
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """
+        Return one line per metric, for printing to the console.
+        """
+        skip = len(self.prefix) + 1
+        return '\n'.join(f'{metric.name[skip:]}: {metric.summary()}' for metric in self.metrics)
+
+
+class MetricsServer():
+    """
+    Serves registry.render() at http://host:port/metrics from a background thread.
+    """
+    def __init__(self, registry, port, host='127.0.0.1'):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.httpd = None
+        self.thread = None
+
+    def start(self):
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='metrics-http',
+                                       daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+            self.thread = None
@@ -0,0 +1,246 @@
+import asyncio
+import os
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+import irc
+import logwriter
+import mcbot as mcb
+from twitchbot import TwitchBot
+
+MODELS = {}  # channel -> MarkovModel, held by each shard process
+
+
+def shard_post(channel, order, texts, word_limit, refresh):
+    """
+    Runs in a shard process: train the channel's model on texts and return a
+    markov sentence, resetting the model afterwards if refresh is set.
+    """
+    model = MODELS.get(channel)
+    if model is None:
+        model = MODELS[channel] = mcb.MarkovModel(order=order)
+    for text in texts:
+        model.add_text(text)
+    sentence = model.generate_sentence(word_limit=word_limit, cap_first=True, end_punc='.')
+    if refresh:
+        MODELS[channel] = mcb.MarkovModel(order=order)
+    return sentence
+
+
+def shard_largest_keys(channel, n):
+    """
+    Runs in a shard process: return the n largest keys of the channel's model.
+    """
+    model = MODELS.get(channel)
+    return [] if model is None else model.largest_keys(n)
+
+
+def shard_prune(matcher):
+    """
+    Runs in a shard process: prune words matched by matcher from all of its models.
+    """
+    return sum(model.prune(matcher.search) for model in MODELS.values())
+
+
+class ModelShards():
+    """
+    Per-channel models sharded across worker processes. Each shard is a
+    single-process executor, so a channel's model always lives in the same
+    process and its updates are applied in order, while different channels
+    train and generate on different cores.
+    """
+    def __init__(self, workers=None, order=1):
+        self.order = order
+        workers = workers or os.cpu_count() or 1
+        self.executors = [ProcessPoolExecutor(max_workers=1) for _ in range(workers)]
+
+    def shard(self, channel):
+        return self.executors[zlib.crc32(channel.encode('utf-8')) % len(self.executors)]
+
+    async def post(self, channel, texts, word_limit, refresh):
+        """
+        Run shard_post for channel in its shard and return the sentence.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.shard(channel), shard_post, channel, self.order,
+                                          texts, word_limit, refresh)
+
+    def largest_keys(self, channel, n):
+        """
+        Queue shard_largest_keys for channel in its shard. Returns a concurrent future.
+        """
+        return self.shard(channel).submit(shard_largest_keys, channel, n)
+
+    def prune(self, matcher):
+        """
+        Queue shard_prune on every shard. Each shard runs it before any post queued after it.
+        """
+        for executor in self.executors:
+            executor.submit(shard_prune, matcher)
+
+    def shutdown(self):
+        for executor in self.executors:
+            executor.shutdown()
+
+
+class Channel():
+    """
+    Settings, message buffer, post timing and counters of one joined channel.
+    """
+    def __init__(self, name, wait=45, word_limit=20, post=True, refresh=True):
+        self.name = name
+        self.wait = wait
+        self.word_limit = word_limit
+        self.post = post
+        self.refresh = refresh
+        self.last_time = time.time()
+        self.msg_buffer = []
+        self.msg_count = 0
+        self.at_count = 0
+
+
+class MultiChannelBot(TwitchBot):
+    """
+    TwitchBot that serves many channels over a single connection. Lines are
+    routed by channel, each channel keeps its own wait, word_limit, post and
+    refresh settings (admin commands change the channel they're sent in),
+    and the per-channel models live in <workers> shard processes.
+    """
+    def __init__(self, user, channels, order=1, admin='', wait=45, post=True, write=True,
+                 refresh=True, workers=None, metrics_port=None, banned_file='banned.txt',
+                 ban_case_fold=False, ban_substring=False, log_dir=logwriter.LOG_DIR,
+                 log_chat=False, ignore_file='ignored.txt', dedup_window=None):
+        super().__init__(user, order=order, admin=admin, wait=wait, post=post, write=write,
+                         refresh=refresh, pool_size=0, metrics_port=metrics_port,
+                         banned_file=banned_file, ban_case_fold=ban_case_fold,
+                         ban_substring=ban_substring, log_dir=log_dir, log_chat=log_chat,
+                         ignore_file=ignore_file, dedup_window=dedup_window)
+        self.channels = {}
+        for name in channels:
+            name = name.lstrip('#').lower()
+            self.channels[name] = Channel(name, wait=wait, word_limit=self.word_limit,
+                                          post=post, refresh=refresh)
+        self.channel = ','.join(self.channels)
+        self.shards = ModelShards(workers, order)
+        self.posting = set()  # tasks generating a post
+
+    def connect(self, host, port, auth, channel=None):
+        """
+        Set the IRC server specified by HOST, PORT and AUTH. The channels are
+        the ones given to the constructor.
+        """
+        super().connect(host, port, auth, self.channel)
+
+    async def open(self):
+        """
+        Open the connection, log in and join every channel.
+        """
+        self.transport = self.new_transport()
+        await self.transport.open()
+        self.transport.send(f"PASS {self.auth} ")
+        self.transport.send(f"NICK {self.user} ")
+        for name in self.channels:
+            self.transport.send(f"JOIN #{name} ")
+        await self.join()
+
+    async def join(self):
+        """
+        Wait until the server has sent the names list of every channel.
+        """
+        remaining = len(self.channels)
+        while remaining:
+            line = await self.transport.readline()
+            if line is None:
+                raise ConnectionError('connection closed while joining channels')
+            print(line)
+            if not self.connected(line):
+                remaining -= 1
+        self.print_message(f'{len(self.channels)} channels joined')
+
+    def status_update(self, chan=None):
+        if chan is not None:
+            return super().status_update(chan)
+        for chan in self.channels.values():
+            self.print_message(f'#{chan.name}')
+            super().status_update(chan)
+        self.print_message(self.stall.summary())
+        if self.dedup is not None:
+            self.print_message(self.dedup.summary())
+        if self.transport is not None:
+            self.print_message(self.transport.summary())
+        self.print_metrics()
+
+    def largest_keys(self, chan, n):
+        """
+        Write the n largest keys of chan's model, fetched from its shard.
+        """
+        future = self.shards.largest_keys(chan.name, n)
+        # the callback runs on the executor's thread, so the file is written off the read loop
+        future.add_done_callback(
+            lambda f: self.profiler.write_keys(f.result(), f'keys-{chan.name}'))
+
+    def prune_banned(self, matcher):
+        self.shards.prune(matcher)
+        self.print_message('pruning newly banned words from channel models')
+
+    async def post_from_shard(self, chan):
+        """
+        Ship chan's buffered messages to its shard and post the sentence it returns.
+        """
+        texts, chan.msg_buffer = chan.msg_buffer, []
+        sentence = await self.shards.post(chan.name, texts, chan.word_limit, chan.refresh)
+        self.curr_time = time.time()
+        chan.last_time = self.curr_time
+        if not sentence:
+            return
+        # if post mode is disabled, bot will print to console
+        if chan.post:
+            self.send_message(sentence, chan.name)
+        else:
+            self.print_message(f'#{chan.name}: {sentence}')
+        self.update_sentences(sentence, chan.name)
+
+    async def process(self):
+        busy = set()  # channels with a post being generated
+        while self.online:
+            line = await self.transport.readline()
+            if line is None:
+                self.print_message('connection closed')
+                break
+            start = time.perf_counter()
+            msg = irc.parse_privmsg(line)
+            self.parse_time.observe(time.perf_counter() - start)
+            self.lines_read.inc()
+            if msg is None:
+                continue
+            chan = self.channels.get(msg.channel)
+            if chan is None or not self.handle_message(msg, chan):
+                continue
+
+            if self.ready(chan) and chan.name not in busy:
+                busy.add(chan.name)
+                task = asyncio.create_task(self.post_from_shard(chan))
+                self.posting.add(task)
+                task.add_done_callback(self.posting.discard)
+                task.add_done_callback(lambda t, name=chan.name: busy.discard(name))
+
+    async def main(self):
+        await self.open()
+        self.online = True
+        now = time.time()
+        for chan in self.channels.values():
+            chan.last_time = now
+        self.status_update()
+        self.stall.start()
+        self.serve_metrics()
+        try:
+            await self.process()
+        finally:
+            await self.shutdown()
+
+    async def shutdown(self):
+        if self.posting:
+            await asyncio.gather(*self.posting, return_exceptions=True)
+        self.shards.shutdown()
+        await super().shutdown()
@@ -1,9 +1,140 @@
 """
-Script to print from filename.
+Stream records from the bot's JSON Lines logs (see logwriter), with
+optional filters, and print them or train a model on them.
+
+Usage: python output.py [paths ...] [--since T] [--until T] [--grep S]
+                        [--channel C] [--user U] [--json | --count]
+                        [--train ORDER --save PATH]
+
+paths are log files or directories of them (default: data/logs). Times are
+unix seconds or ISO dates like 2024-01-31 or 2024-01-31T18:00. Records are
+read one line at a time, so memory use doesn't grow with the size of the logs.
 """
-file_name = 'file_name.txt'
-with open(file_name, 'r') as f:
-    d = eval(f.read())
-for v in d.values():
-    print(v)
-    print()
+import argparse
+import datetime
+import glob
+import json
+import os
+import time
+
+import logwriter
+import mcbot as mcb
+
+
+def log_sort_key(path):
+    """
+    Sort <prefix>-<date>-<n>.jsonl files by name and then numerically by n.
+    """
+    stem, _, n = os.path.basename(path)[:-len('.jsonl')].rpartition('-')
+    return os.path.dirname(path), stem, int(n) if n.isdigit() else -1
+
+
+def expand_paths(paths):
+    """
+    Yield the log files named by paths, listing directories and glob patterns in order.
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            yield from sorted(glob.glob(os.path.join(path, '*.jsonl')), key=log_sort_key)
+        elif os.path.exists(path):
+            yield path
+        else:
+            yield from sorted(glob.glob(path), key=log_sort_key)
+
+
+def parse_time(value):
+    """
+    Return the unix time of value, given as seconds or an ISO date (local time).
+    """
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.datetime.fromisoformat(value).timestamp()
+
+
+def iter_records(paths, since=None, until=None, contains=None, channel=None, user=None):
+    """
+    Yield the records of the log files in paths that match every given filter:
+    time in [since, until), contains as a substring of the text, and the exact
+    channel and user. Lines that aren't valid records are skipped.
+    """
+    # json escapes character by character, so the escaped text contains the escaped substring
+    raw = None if contains is None else json.dumps(contains, ensure_ascii=False)[1:-1]
+    for path in expand_paths(paths):
+        with open(path, encoding='utf-8', errors='replace') as f:
+            for line in f:
+                # cheap substring test before paying for json parsing
+                if raw is not None and raw not in line:
+                    continue
+                try:
+                    record = json.loads(line)
+                    t = record['time']
+                    text = record['text']
+                except (ValueError, KeyError, TypeError):
+                    continue
+                if since is not None and t < since:
+                    continue
+                if until is not None and t >= until:
+                    continue
+                if contains is not None and contains not in text:
+                    continue
+                if channel is not None and record.get('channel') != channel:
+                    continue
+                if user is not None and record.get('user') != user:
+                    continue
+                yield record
+
+
+def train_model(model, records):
+    """
+    Train model on the text of each record, returning the number of records used.
+    """
+    n = 0
+    for record in records:
+        model.add_text(record['text'])
+        n += 1
+    return n
+
+
+def format_record(record):
+    stamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(record['time']))
+    user = record.get('user')
+    who = f'#{record.get("channel", "")}' + (f' {user}' if user else '')
+    return f'{stamp} {who}: {record["text"]}'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('paths', nargs='*', default=[logwriter.LOG_DIR],
+                        help='log files, directories or glob patterns')
+    parser.add_argument('--since', type=parse_time, help='earliest time to include')
+    parser.add_argument('--until', type=parse_time, help='time to stop at (exclusive)')
+    parser.add_argument('--grep', help='only records whose text contains this')
+    parser.add_argument('--channel', help='only records from this channel')
+    parser.add_argument('--user', help='only records from this user')
+    parser.add_argument('--json', action='store_true', help='print records as JSON lines')
+    parser.add_argument('--count', action='store_true', help='only print the number of records')
+    parser.add_argument('--train', type=int, metavar='ORDER', help='train a model of this order')
+    parser.add_argument('--save', help='path to save the trained model snapshot to')
+    args = parser.parse_args()
+
+    records = iter_records(args.paths, since=args.since, until=args.until, contains=args.grep,
+                           channel=args.channel, user=args.user)
+    if args.train is not None:
+        model = mcb.MarkovModel(order=args.train)
+        start = time.perf_counter()
+        n = train_model(model, records)
+        elapsed = time.perf_counter() - start
+        print(f'trained on {n} records in {elapsed:.1f}s, {len(model.vocab)} words')
+        if args.save:
+            model.save(args.save)
+            print(f'saved to {args.save}')
+    elif args.count:
+        print(sum(1 for _ in records))
+    else:
+        for record in records:
+            print(json.dumps(record, ensure_ascii=False) if args.json else format_record(record))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+import threading
+from collections import deque
+
+
+class SentencePool():
+    """
+    Bounded pool of pre-generated markov sentences. A background thread keeps
+    the pool topped up in batches via generate_sentences, so posting only has
+    to pop a sentence that already exists. The owner clears the pool to have
+    it regenerated from the model as it is now.
+
+    get_model is a callable returning the current model (the bot may replace
+    its model on refresh), and lock guards the model against concurrent updates.
+    """
+    def __init__(self, get_model, lock, size=32, batch=8, word_limit=20):
+        self.get_model = get_model
+        self.lock = lock
+        self.size = size
+        self.batch = batch
+        self.word_limit = word_limit
+        self.sentences = deque(maxlen=size)
+        self.wake = threading.Event()
+        self.running = False
+        self.thread = None
+
+    def __len__(self):
+        return len(self.sentences)
+
+    def start(self):
+        """
+        Start the background refill thread.
+        """
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='sentence-pool', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop the background refill thread.
+        """
+        self.running = False
+        self.wake.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def notify(self):
+        """
+        Signal that the model has changed and the pool may be refilled.
+        """
+        self.wake.set()
+
+    def clear(self):
+        """
+        Drop all pooled sentences and refill the pool, e.g. after the model is
+        refreshed or has been trained on since, or the word limit changes.
+        """
+        self.sentences.clear()
+        self.wake.set()
+
+    def pop(self):
+        """
+        Return a pooled sentence, or None if the pool is empty.
+        """
+        try:
+            sentence = self.sentences.popleft()
+        except IndexError:
+            return None
+        self.wake.set()
+        return sentence
+
+    def fill(self):
+        """
+        Generate sentences until the pool is full. Does nothing while the model is untrained.
+        """
+        while self.running and len(self.sentences) < self.size:
+            with self.lock:
+                model = self.get_model()
+                if model.empty():
+                    return
+                n = min(self.batch, self.size - len(self.sentences))
+                batch = model.generate_sentences(n, word_limit=self.word_limit,
+                                                 cap_first=True, end_punc='.')
+                self.sentences.extend(batch)
+
+    def run(self):
+        while self.running:
+            self.wake.wait()
+            self.wake.clear()
+            self.fill()
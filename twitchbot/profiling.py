@@ -0,0 +1,133 @@
+"""
+On-demand diagnostics for a running bot, triggered by admin commands: a
+cProfile run of the read loop and model worker threads, tracemalloc
+snapshots with diffs, and the model's largest keys. The work runs on
+executor threads or the model worker, and results are written to files,
+so the read loop keeps reading while it happens.
+"""
+import cProfile
+import io
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+
+PROFILE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'profiles')
+TOP = 40  # lines of each report
+
+
+def output_path(directory, name, ext):
+    os.makedirs(directory, exist_ok=True)
+    stamp = time.strftime('%Y-%m-%d_%H-%M-%S', time.localtime())
+    return os.path.join(directory, f'{stamp}-{name}.{ext}')
+
+
+class Profiler():
+    """
+    Diagnostics writer for one bot. print_message reports where results went.
+    """
+    def __init__(self, directory=PROFILE_DIR, print_message=print):
+        self.directory = directory
+        self.print_message = print_message
+        self.profiling = False
+        self.snapshot = None  # last tracemalloc snapshot, to diff the next one against
+        self.lock = threading.Lock()  # serializes tracemalloc snapshots
+
+    def profile(self, loop, worker, seconds):
+        """
+        Profile the event loop thread, and the model worker's thread if worker
+        is given, for seconds, then write their stats.
+        """
+        if self.profiling:
+            self.print_message('a profile is already running')
+            return
+        self.profiling = True
+        profiles = [('loop', cProfile.Profile())]
+        if worker is not None:
+            profiles.append(('worker', cProfile.Profile()))
+            # a profiler only sees the thread that enabled it
+            worker.call(profiles[1][1].enable)
+        profiles[0][1].enable()
+        self.print_message(f'profiling for {seconds}s')
+
+        def finish():
+            profiles[0][1].disable()
+            done = threading.Event()
+            if worker is not None:
+                worker.call(lambda: (profiles[1][1].disable(), done.set()))
+            else:
+                done.set()
+            loop.run_in_executor(None, self.write_profiles, profiles, done)
+
+        loop.call_later(seconds, finish)
+
+    def write_profiles(self, profiles, done):
+        done.wait(60)
+        try:
+            for name, profile in profiles:
+                path = output_path(self.directory, f'profile-{name}', 'prof')
+                profile.dump_stats(path)
+                out = io.StringIO()
+                pstats.Stats(profile, stream=out).sort_stats('cumulative').print_stats(TOP)
+                with open(path[:-len('.prof')] + '.txt', 'w', encoding='utf-8') as f:
+                    f.write(out.getvalue())
+                self.print_message(f'{name} profile written to {path}')
+        finally:
+            self.profiling = False
+
+    def memory_snapshot(self, loop):
+        """
+        Take a tracemalloc snapshot (starting tracing on first use) and write
+        the top allocations, and the changes since the previous snapshot.
+        """
+        loop.run_in_executor(None, self.write_snapshot)
+
+    def write_snapshot(self):
+        with self.lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.snapshot = None
+                self.print_message('tracemalloc started, only allocations from now on are traced')
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            path = output_path(self.directory, 'memory', 'txt')
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(f'traced memory: {current / 1e6:.1f} MB, peak {peak / 1e6:.1f} MB\n\n')
+                f.write('top allocations:\n')
+                for stat in snapshot.statistics('lineno')[:TOP]:
+                    f.write(f'{stat}\n')
+                if self.snapshot is not None:
+                    f.write('\nchanges since the last snapshot:\n')
+                    for stat in snapshot.compare_to(self.snapshot, 'lineno')[:TOP]:
+                        f.write(f'{stat}\n')
+            self.snapshot = snapshot
+        self.print_message(f'memory snapshot written to {path}')
+
+    def stop_tracing(self):
+        with self.lock:
+            tracemalloc.stop()
+            self.snapshot = None
+        self.print_message('tracemalloc stopped')
+
+    def largest_keys(self, loop, get_model, lock, n):
+        """
+        Write the model's n largest keys by successor count.
+        """
+        loop.run_in_executor(None, self.write_largest_keys, get_model, lock, n)
+
+    def write_largest_keys(self, get_model, lock, n):
+        with lock:
+            rows = get_model().largest_keys(n)
+        self.write_keys(rows)
+
+    def write_keys(self, rows, name='keys'):
+        """
+        Write rows as returned by MarkovModel.largest_keys.
+        """
+        path = output_path(self.directory, name, 'txt')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('successors\tcount\tcontext\n')
+            for context, successors, count in rows:
+                f.write(f'{successors}\t{count}\t{" ".join(context)}\n')
+        self.print_message(f'{len(rows)} largest keys written to {path}')
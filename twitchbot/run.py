@@ -1,6 +1,6 @@
 from twitchbot import *
 from auth import *
 
-bot = TwitchBot(user=USER, admin=ADMIN)
+bot = TwitchBot(user=USER, admin=ADMIN, checkpoint_dir=checkpoint.CHECKPOINT_DIR, dedup_window=30)
 bot.connect(host=HOST, port=PORT, auth=AUTH, channel=CHANNEL)
 bot.run()
@@ -0,0 +1,406 @@
+"""
+Binary snapshot format for MarkovModel.
+
+A snapshot file is a sequence of segments. The first segment holds a full
+model, and each later segment is a delta appended by save(path, delta=True).
+Every segment starts with a fixed little-endian header followed by 8-byte
+aligned sections:
+
+    header          magic, version, flags, order, first_word, n_words,
+                    n_keys, n_edges, blob_size
+    word offsets    (n_words + 1) uint64 offsets into the vocabulary blob
+    keys            n_keys contexts of <order> big-endian uint32 token ids,
+                    sorted so that lookups are a binary search; in a
+                    backoff model's snapshot (flag FLAG_BACKOFF) each is
+                    preceded by a uint32 context length
+    row offsets     (n_keys + 1) uint64 offsets into the edge arrays (CSR)
+    key weights     n_keys uint64 running totals of successor counts
+    successors      n_edges uint32 token ids
+    counts          n_edges uint32 counts
+    vocabulary      blob_size bytes of newline-terminated utf-8 words
+
+Word ids in a segment start at first_word. A delta segment carries only the
+words added since the previous save, and its rows replace the rows of the
+same contexts in earlier segments (an empty row deletes the context).
+"""
+import io
+import mmap as mmap_module
+import os
+import struct
+from array import array
+from bisect import bisect_left, bisect_right
+
+import numpy as np
+
+MAGIC = b'MCBM'
+VERSION = 1
+FLAG_DELTA = 1
+FLAG_BACKOFF = 2
+HEADER = struct.Struct('<4sHHIQQQQQ')
+
+
+def align(n):
+    return (n + 7) & ~7
+
+
+def key_width(order, backoff=False):
+    """
+    Return the size in bytes of a stored context key.
+    """
+    return 4 * (order + 1) if backoff else 4 * order
+
+
+def key_bytes(key, width):
+    """
+    Encode a packed context key as its sortable on-disk form, width bytes long.
+    """
+    return key.to_bytes(width, 'big')
+
+
+def key_column(raw, start, stop):
+    """
+    Return bytes start:stop of every key in raw, an (n_keys, key_width) uint8
+    array, each read as a big-endian number, in an array('Q').
+    """
+    padded = np.zeros((len(raw), 8), dtype=np.uint8)
+    padded[:, 8 - (stop - start):] = raw[:, start:stop]
+    column = array('Q')
+    column.frombytes(padded.view('>u8').astype(np.uint64).tobytes())
+    return column
+
+
+def write_segment(f, order, first_word, words, rows, delta=False, backoff=False):
+    """
+    Write one segment to the binary file f.
+
+    words is the list of words with ids first_word, first_word + 1, ..., and
+    rows is a list of (key, successors, counts) tuples with packed context
+    keys, which are length-tagged if backoff is set (see BackoffModel).
+    """
+    word_offsets, blob = pack_words(words)
+    keys, row_offsets, succ, counts = pack_rows(key_width(order, backoff), rows)
+    write_sections(f, order, first_word, word_offsets, blob, keys, row_offsets, succ, counts,
+                   delta, backoff)
+
+
+def pack_words(words):
+    """
+    Return the word offsets and vocabulary blob sections of a list of words.
+    """
+    encoded = [w.encode('utf-8') + b'\n' for w in words]
+    word_offsets = array('Q', (0,))
+    for w in encoded:
+        word_offsets.append(word_offsets[-1] + len(w))
+    return word_offsets, b''.join(encoded)
+
+
+def pack_rows(width, rows):
+    """
+    Return the keys, row offsets, successors and counts sections of rows, an
+    iterable of (key, successors, counts) tuples, sorted by key. Keys are
+    stored in width bytes.
+    """
+    return sort_rows(*pack_edges(width, rows))
+
+
+def pack_edges(width, rows):
+    """
+    Return rows as unsorted NumPy arrays (keys, row lengths, successors,
+    counts), the form sort_rows takes.
+    """
+    keys = bytearray()
+    lengths = array('Q')
+    succ, counts = array('I'), array('I')
+    for key, row_succ, row_counts in rows:
+        keys += key_bytes(key, width)
+        succ.extend(row_succ)
+        counts.extend(row_counts)
+        lengths.append(len(row_succ))
+    return (np.frombuffer(keys, dtype=f'S{width}'),
+            np.frombuffer(lengths, dtype=np.uint64).astype(np.intp),
+            np.frombuffer(succ, dtype=np.uint32), np.frombuffer(counts, dtype=np.uint32))
+
+
+def sort_rows(keys, lengths, succ, counts):
+    """
+    Sort rows by key with NumPy. keys and lengths are arrays with one entry
+    per row, and succ and counts hold the rows' edges back to back in the
+    same order. Returns the keys, row offsets, successors and counts sections.
+    """
+    # rows are contiguous in the edges: gather them in key order
+    starts = np.zeros(len(lengths), dtype=np.intp)
+    np.cumsum(lengths[:-1], out=starts[1:])
+    perm = np.argsort(keys, kind='stable')
+    lengths = lengths[perm]
+    row_offsets = np.zeros(len(perm) + 1, dtype=np.uint64)
+    np.cumsum(lengths, out=row_offsets[1:])
+    gather = np.repeat(starts[perm] - row_offsets[:-1].astype(np.intp), lengths)
+    gather += np.arange(len(gather), dtype=np.intp)
+    return keys[perm], row_offsets, succ[gather], counts[gather]
+
+
+def write_sections(f, order, first_word, word_offsets, blob, keys, row_offsets, succ, counts,
+                   delta=False, backoff=False):
+    """
+    Write a segment header and its sections to f. The key weights are
+    computed from the counts; everything else is written as given.
+    """
+    running = np.zeros(len(counts) + 1, dtype=np.uint64)
+    np.cumsum(np.frombuffer(counts, dtype=np.uint32), out=running[1:])
+    key_weights = running[np.frombuffer(row_offsets, dtype=np.uint64)[1:].astype(np.intp)]
+    flags = (FLAG_DELTA if delta else 0) | (FLAG_BACKOFF if backoff else 0)
+    f.write(HEADER.pack(MAGIC, VERSION, flags, order, first_word,
+                        len(word_offsets) - 1, len(row_offsets) - 1, len(succ), len(blob)))
+    f.write(b'\0' * (align(HEADER.size) - HEADER.size))
+    for section in (word_offsets, keys, row_offsets, key_weights, succ, counts, blob):
+        section = memoryview(section).cast('B')
+        f.write(section)
+        f.write(b'\0' * (align(len(section)) - len(section)))
+
+
+class Segment():
+    """
+    Read-only view of one segment inside a snapshot buffer. Section arrays
+    are memoryviews into the buffer, so nothing is copied on open.
+    """
+    def __init__(self, buf, offset):
+        (magic, version, flags, self.order, self.first_word, self.n_words,
+         self.n_keys, self.n_edges, blob_size) = HEADER.unpack_from(buf, offset)
+        if magic != MAGIC:
+            raise ValueError('not a markov model snapshot')
+        if version != VERSION:
+            raise ValueError(f'unsupported snapshot version {version} (expected {VERSION})')
+        self.delta = bool(flags & FLAG_DELTA)
+        self.backoff = bool(flags & FLAG_BACKOFF)
+        view = memoryview(buf)
+        width = key_width(self.order, self.backoff)
+
+        pos = offset + align(HEADER.size)
+        sections = []
+        for size in (8 * (self.n_words + 1), width * self.n_keys, 8 * (self.n_keys + 1),
+                     8 * self.n_keys, 4 * self.n_edges, 4 * self.n_edges, blob_size):
+            sections.append((pos, size))
+            pos += align(size)
+        self.end = pos
+
+        (wo, wo_size), (k, k_size), (ro, ro_size), (kw, kw_size), \
+            (s, s_size), (c, c_size), (b, b_size) = sections
+        self.word_offsets = view[wo:wo + wo_size].cast('Q')
+        self.key_array = np.frombuffer(buf, dtype=f'S{width}', count=self.n_keys, offset=k)
+        self.key_view = view[k:k + k_size]
+        self.row_offsets = view[ro:ro + ro_size].cast('Q')
+        self.key_weights = np.frombuffer(buf, dtype=np.uint64, count=self.n_keys, offset=kw)
+        self.succ = view[s:s + s_size].cast('I')
+        self.counts = view[c:c + c_size].cast('I')
+        self.blob = view[b:b + b_size]
+        self.key_width = width
+        self.key_high = None  # first 8 bytes of each key as ints, built on the first find
+        self.key_low = None  # the rest, for keys wider than 8 bytes
+        self.low_bits = 8 * max(width - 8, 0)
+
+    @property
+    def total(self):
+        return int(self.key_weights[-1]) if self.n_keys else 0
+
+    def word(self, token):
+        """
+        Decode the word with (global) id token.
+        """
+        i = token - self.first_word
+        return str(self.blob[self.word_offsets[i]:self.word_offsets[i + 1] - 1], 'utf-8')
+
+    def all_words(self):
+        """
+        Decode every word in the segment, in id order.
+        """
+        if not self.n_words:
+            return []
+        return str(self.blob, 'utf-8')[:-1].split('\n')
+
+    def key(self, i):
+        """
+        Return the packed context key of row i.
+        """
+        w = self.key_width
+        return int.from_bytes(self.key_view[i * w:(i + 1) * w], 'big')
+
+    def find(self, key):
+        """
+        Return the row index of a packed context key, or None if it isn't present.
+
+        Keys of up to 16 bytes are searched by bisecting native integer copies
+        of them, split into a high and a low 8 bytes, which is several times
+        faster than a NumPy search for a single key. The copies are made on
+        the first lookup and take 8 bytes per key and part.
+        """
+        if not self.n_keys:
+            return None
+        if self.key_width > 16:
+            target = key_bytes(key, self.key_width)
+            i = int(np.searchsorted(self.key_array, target))
+            if i < self.n_keys and self.key_view[i * self.key_width:(i + 1) * self.key_width] == target:
+                return i
+            return None
+        if self.key_high is None:
+            raw = np.frombuffer(self.key_view, dtype=np.uint8).reshape(-1, self.key_width)
+            self.key_high = key_column(raw, 0, min(self.key_width, 8))
+            if self.low_bits:
+                self.key_low = key_column(raw, 8, self.key_width)
+        high = key >> self.low_bits
+        i = bisect_left(self.key_high, high)
+        if self.low_bits:
+            low = key & ((1 << self.low_bits) - 1)
+            i = bisect_left(self.key_low, low, i, bisect_right(self.key_high, high, i))
+            if i < self.n_keys and self.key_high[i] == high and self.key_low[i] == low:
+                return i
+        elif i < self.n_keys and self.key_high[i] == high:
+            return i
+        return None
+
+    def row(self, i):
+        """
+        Return the (successors, counts) memoryviews of row i.
+        """
+        lo, hi = self.row_offsets[i], self.row_offsets[i + 1]
+        return self.succ[lo:hi], self.counts[lo:hi]
+
+    def weighted_row(self, r):
+        """
+        Return the row whose running key weight range contains r, for 0 <= r < total.
+        """
+        return int(np.searchsorted(self.key_weights, r, side='right'))
+
+    def rows(self):
+        """
+        Iterate over (key, successors, counts) for every row.
+        """
+        for i in range(self.n_keys):
+            succ, counts = self.row(i)
+            yield self.key(i), succ, counts
+
+
+class Snapshot():
+    """
+    An open snapshot file. With mmap, the file is memory-mapped read-only so
+    that opening is O(1) and processes loading the same file share its pages;
+    otherwise it is read into memory.
+    """
+    def __init__(self, path, mmap=True):
+        self.path = path
+        with open(path, 'rb') as f:
+            if mmap:
+                self.buf = mmap_module.mmap(f.fileno(), 0, access=mmap_module.ACCESS_READ)
+            else:
+                self.buf = f.read()
+        self.read_segments()
+
+    @classmethod
+    def from_bytes(cls, buf):
+        """
+        Open a snapshot held in memory, such as one made by snapshot_bytes.
+        """
+        snap = cls.__new__(cls)
+        snap.path = '<memory>'
+        snap.buf = buf
+        snap.read_segments()
+        return snap
+
+    def read_segments(self):
+        self.segments = []
+        offset = 0
+        while offset < len(self.buf):
+            segment = Segment(self.buf, offset)
+            if self.segments and (segment.order, segment.backoff) != (self.order, self.backoff):
+                raise ValueError('snapshot segments disagree on model order')
+            self.segments.append(segment)
+            offset = segment.end
+        if not self.segments or self.segments[0].delta:
+            raise ValueError(f'{self.path} does not start with a full snapshot')
+
+    @property
+    def order(self):
+        return self.segments[0].order
+
+    @property
+    def backoff(self):
+        return self.segments[0].backoff
+
+    @property
+    def base(self):
+        return self.segments[0]
+
+    @property
+    def deltas(self):
+        return self.segments[1:]
+
+    def close(self):
+        """
+        Release the mapping. Views handed out by the segments become invalid.
+        """
+        self.segments = []
+        if isinstance(self.buf, mmap_module.mmap):
+            try:
+                self.buf.close()
+            except BufferError:
+                pass  # still referenced by a loaded model; closed when it is collected
+
+
+def write_snapshot(path, order, words, rows, backoff=False):
+    """
+    Write a full snapshot to path atomically via a temporary file.
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        write_segment(f, order, 0, words, rows, backoff=backoff)
+    os.replace(tmp_path, path)
+
+
+def snapshot_bytes(order, words, rows, backoff=False):
+    """
+    Return a full snapshot as bytes, to use in memory with Snapshot.from_bytes.
+    """
+    f = io.BytesIO()
+    write_segment(f, order, 0, words, rows, backoff=backoff)
+    return f.getvalue()
+
+
+def merged_bytes(base, dropped, words, rows, all_words=False):
+    """
+    Return a full snapshot, as bytes, of the rows of segment base except the
+    row indices in dropped, together with rows (an iterable of (key,
+    successors, counts) tuples whose keys have no row left in base). words
+    are appended to base's vocabulary, or with all_words replace it. The
+    rows of base are copied and merged in bulk with NumPy, so only the new
+    rows cost Python work.
+    """
+    new_words, blob = pack_words(words)
+    new_keys, new_lengths, new_succ, new_counts = pack_edges(base.key_width, rows)
+    keep = np.ones(base.n_keys, dtype=bool)
+    keep[np.fromiter(dropped, dtype=np.intp, count=len(dropped))] = False
+    base_lengths = np.diff(np.frombuffer(base.row_offsets, dtype=np.uint64).astype(np.intp))
+    edges = np.repeat(keep, base_lengths)
+    keys, row_offsets, succ, counts = sort_rows(
+        np.concatenate((base.key_array[keep], new_keys)),
+        np.concatenate((base_lengths[keep], new_lengths)),
+        np.concatenate((np.frombuffer(base.succ, dtype=np.uint32)[edges], new_succ)),
+        np.concatenate((np.frombuffer(base.counts, dtype=np.uint32)[edges], new_counts)))
+
+    if all_words:
+        word_offsets = new_words
+    else:
+        base_words = np.frombuffer(base.word_offsets, dtype=np.uint64)
+        word_offsets = np.concatenate((base_words, base_words[-1] + np.frombuffer(
+            new_words, dtype=np.uint64)[1:]))
+        blob = bytes(base.blob) + blob
+    f = io.BytesIO()
+    write_sections(f, base.order, base.first_word, word_offsets, blob,
+                   keys, row_offsets, succ, counts, backoff=base.backoff)
+    return f.getvalue()
+
+
+def append_delta(path, order, first_word, words, rows, backoff=False):
+    """
+    Append a delta segment to an existing snapshot at path.
+    """
+    with open(path, 'ab') as f:
+        write_segment(f, order, first_word, words, rows, delta=True, backoff=backoff)
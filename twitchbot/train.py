@@ -0,0 +1,140 @@
+"""
+Streaming, multi-process corpus trainer for MarkovModel.
+
+The corpus is read in fixed-size chunks cut at whitespace, so no token is
+split. Each chunk's n-grams are counted in a worker process with a
+chunk-local vocabulary, and the partial count tables are merged into the
+model in corpus order. N-grams that cross a chunk boundary are counted by
+the parent from the last <order> tokens of one chunk and the first <order>
+tokens of the next.
+"""
+import os
+import time
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+WHITESPACE = b' \t\n\r\x0b\x0c'
+
+
+def iter_chunks(f, chunk_size):
+    """
+    Yield utf-8 decoded chunks of roughly chunk_size bytes from the binary
+    file f, each ending at a whitespace byte (or at the end of the file).
+    """
+    rest = b''
+    while True:
+        data = f.read(chunk_size)
+        if not data:
+            break
+        data = rest + data
+        cut = max(data.rfind(c) for c in WHITESPACE)
+        if cut < 0:
+            rest = data
+            continue
+        rest = data[cut + 1:]
+        yield len(data) - len(rest), data[:cut + 1].decode('utf-8', errors='replace')
+    if rest:
+        yield len(rest), rest.decode('utf-8', errors='replace')
+
+
+def count_chunk(order, text):
+    """
+    Count the n-grams that start inside one chunk of text.
+
+    Returns (words, contexts, rows, head, tail, n_tokens): the chunk-local
+    vocabulary, a flat array('I') of <order> local ids per distinct context,
+    a (lengths, successors, counts) tuple of arrays holding the successor row
+    of each context, the first and last <order> tokens of the chunk, and the
+    number of tokens in it.
+    """
+    tokens = text.split()
+    vocab = {}
+    ids = [vocab.setdefault(w, len(vocab)) for w in tokens]
+    table = {}
+    for i in range(len(ids) - order):
+        context = tuple(ids[i:i + order])
+        row = table.get(context)
+        if row is None:
+            row = table[context] = {}
+        t = ids[i + order]
+        row[t] = row.get(t, 0) + 1
+    contexts, lengths, succ, counts = array('I'), array('I'), array('I'), array('I')
+    for context, row in table.items():
+        contexts.extend(context)
+        lengths.append(len(row))
+        succ.extend(row.keys())
+        counts.extend(row.values())
+    return (list(vocab), contexts, (lengths, succ, counts),
+            tokens[:order], tokens[-order:], len(tokens))
+
+
+def merge_counts(model, words, contexts, rows):
+    """
+    Add a partial count table from count_chunk to model.
+    """
+    ids = [model.intern(w) for w in words]
+    order = model.order
+    lengths, succ, counts = rows
+    pos = 0
+    for j, length in enumerate(lengths):
+        key = model.pack([ids[t] for t in contexts[j * order:(j + 1) * order]])
+        end = pos + length
+        model.add_row(key, [ids[t] for t in succ[pos:end]], counts[pos:end])
+        pos = end
+
+
+def print_progress(done, total, elapsed):
+    rate = done / elapsed / 1e6 if elapsed > 0 else 0.0
+    percent = f' ({100 * done / total:.0f}%)' if total else ''
+    print(f'[TRAIN] {done / 1e6:.1f}/{total / 1e6:.1f} MB{percent} {rate:.1f} MB/s')
+
+
+def train_file(model, path, workers=None, chunk_size=1 << 22, progress=print_progress):
+    """
+    Train model on the text file at path, treating the whole file as one
+    token stream. workers is the number of counting processes (default: one
+    per CPU); with workers=1 everything runs in this process. progress is
+    called as progress(bytes_done, bytes_total, seconds_elapsed) after each
+    chunk is merged, or pass None to disable it. Returns the throughput in MB/s.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    order = model.order
+    total = os.path.getsize(path)
+    done = 0
+    carry = []  # last <order> tokens seen, for n-grams crossing chunk boundaries
+    start = time.perf_counter()
+
+    def merge(size, result):
+        nonlocal done, carry
+        words, contexts, rows, head, tail, n_tokens = result
+        seq = carry + head
+        for j in range(len(carry), len(seq)):
+            if j >= order:
+                model.update_dict(seq[j - order:j + 1])
+        merge_counts(model, words, contexts, rows)
+        model.word_count += n_tokens
+        carry = (carry + tail)[-order:]
+        done += size
+        if progress is not None:
+            progress(done, total, time.perf_counter() - start)
+
+    with open(path, 'rb') as f:
+        if workers <= 1:
+            for size, text in iter_chunks(f, chunk_size):
+                merge(size, count_chunk(order, text))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                # bound the chunks in flight so the corpus is never fully in memory
+                pending = deque()
+                for size, text in iter_chunks(f, chunk_size):
+                    pending.append((size, executor.submit(count_chunk, order, text)))
+                    if len(pending) >= 2 * workers:
+                        size, future = pending.popleft()
+                        merge(size, future.result())
+                while pending:
+                    size, future = pending.popleft()
+                    merge(size, future.result())
+    elapsed = time.perf_counter() - start
+    return done / elapsed / 1e6 if elapsed > 0 else 0.0
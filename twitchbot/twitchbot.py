@@ -1,12 +1,26 @@
-import socket
+import asyncio
+import threading
 import time
-import os
 import mcbot as mcb
-import re
+import banned
+import checkpoint
+import dedup
+import irc
+import logwriter
+import metrics
+import profiling
+import window
+from pool import SentencePool
+from worker import ModelWorker, StallMeter
 
 
 class TwitchBot:
-    def __init__(self, user, order=1, admin='', wait=45, post=True, write=True, refresh=True):
+    def __init__(self, user, order=1, admin='', wait=45, post=True, write=True, refresh=True,
+                 pool_size=32, model_path=None, banned_file='banned.txt', ban_case_fold=False,
+                 ban_substring=False, window_messages=None, window_seconds=None, half_life=None,
+                 log_dir=logwriter.LOG_DIR, log_chat=False, metrics_port=None, seed_cap=None,
+                 backoff=False, reply=False, checkpoint_dir=None, checkpoint_interval=300,
+                 ignore_file='ignored.txt', dedup_window=None):
         self.user = user
         self.admin = admin
         self.channel = ''
@@ -14,11 +28,24 @@ class TwitchBot:
         self.port = 0
         self.host = ''
         self.order = order
-        if self.order == 1:
-            self.mc_bot = mcb.MCBot()
-        else:
-            self.mc_bot = mcb.MCBot2()
-        self.s = socket.socket()
+        # optional pre-trained snapshot that the model starts from (and refreshes back to)
+        self.model_path = model_path
+        # optional bounded-memory training: a sliding window of recent messages
+        # (window_messages and/or window_seconds) or exponential decay (half_life, seconds)
+        self.window_messages = window_messages
+        self.window_seconds = window_seconds
+        self.half_life = half_life
+        # start sentences from the openings of up to seed_cap past messages
+        self.seed_cap = seed_cap
+        # one model over contexts of every length up to order, backing off to shorter ones
+        self.backoff = backoff
+        # answer messages that @ the bot with a sentence around one of their words
+        self.reply = reply
+        self.reply_pending = False
+        self.mc_bot = None
+        self.window = None
+        self.refresh_mc_bot()
+        self.transport = None  # irc.IRCConnection, opened by run()
         self.encoding = 'utf-8'
         self.curr_time = time.time()
         self.last_time = self.curr_time
@@ -27,29 +54,136 @@ class TwitchBot:
         self.write = write
         self.refresh = refresh
         self.online = False  # bot connected
-        self.all_logs, self.markov_sentences = {}, {}
+        # generated sentences (and chat, if log_chat is set) are streamed to JSON Lines files
+        self.sentence_log = logwriter.JsonLinesWriter('markov', log_dir)
+        self.chat_log = logwriter.JsonLinesWriter('chat', log_dir) if log_chat else None
         self.msg_buffer = []
         self.msg_count, self.sentences_count = 0, 0
         # default wait time (seconds) between bot posts
         self.wait = wait
         self.word_limit = 20
         self.at_count = 0
-        self.banned = self.read_banned()
+        self.model_lock = threading.Lock()  # guards mc_bot against the sentence pool thread
+        # reloaded when the file changes; newly banned words are pruned from the model
+        self.banned = banned.BannedWords(banned_file, case_fold=ban_case_fold,
+                                         substring=ban_substring, on_added=self.prune_banned)
+        # users whose messages are skipped, reloaded when the file changes
+        self.ignored_users = banned.IgnoredUsers(ignore_file)
+        # near-copies of a message from the last dedup_window seconds aren't trained on
+        self.dedup = None if dedup_window is None else dedup.NearDuplicateFilter(dedup_window)
+        # pre-generated sentences, refilled in the background
+        self.sentence_pool = SentencePool(lambda: self.mc_bot, self.model_lock,
+                                          size=pool_size, word_limit=self.word_limit)
+        # the pool is regenerated from the latest chat this many seconds before each post
+        self.pool_lead = 5
+        self.pool_refilled = False  # the pool has been regenerated since the last post
+        # trains on chat and generates posts off the event loop
+        self.worker = ModelWorker(self.ingest, self.generate, self.deliver_sentence,
+                                  print_message=self.print_message)
+        self.post_pending = False  # a post has been requested from the worker
+        # byte estimate of the model, refreshed on the worker every stats_interval seconds
+        self.stats_interval = 30
+        self.model_bytes = 0
+        self.model_bytes_time = 0.0
+        self.stall = StallMeter()
+        self.loop = None
+        # counters, latency histograms and gauges, served on localhost:metrics_port if given
+        self.metrics_port = metrics_port
+        self.metrics_server = None
+        self.setup_metrics()
+        self.profiler = profiling.Profiler(print_message=self.print_message)
+        # periodic model snapshots plus a log of the messages since, restored on startup
+        self.ingested = 0  # messages trained on, numbered like msg_count
+        self.checkpoints = None
+        self.checkpoint_interval = checkpoint_interval
+        self.checkpoint_task = None
+        if checkpoint_dir is not None:
+            self.checkpoints = checkpoint.Checkpointer(checkpoint_dir, self.print_message)
+            self.restore()
+
+
+    def setup_metrics(self):
+        """
+        Create the bot's metrics. Parsing and banned word checks are timed on
+        the read loop, add_text and generation on the model worker, and socket
+        writes by the transport.
+        """
+        m = self.metrics = metrics.Registry()
+        self.lines_read = m.counter('lines_total', 'Lines read from the server, other than PINGs')
+        self.parse_time = m.histogram('parse_seconds', 'Time to parse a line')
+        self.banned_time = m.histogram('banned_seconds', 'Time to check a message for banned words')
+        self.dedup_time = m.histogram('dedup_seconds', 'Time to check a message for near-duplicates')
+        self.banned_total = m.counter('banned_total', 'Messages dropped for banned words')
+        m.gauge('duplicates_dropped', 'Messages dropped as near-duplicates',
+                lambda: 0 if self.dedup is None else self.dedup.dropped)
+        self.add_text_time = m.histogram('add_text_seconds', 'Time to train the model on a message')
+        self.generate_time = m.histogram('generate_seconds', 'Time to generate a sentence')
+        self.checkpoint_time = m.histogram('checkpoint_seconds',
+                                           'Time the model is held to start a checkpoint')
+        self.reply_time = m.histogram('reply_seconds', 'Time to generate a reply')
+        self.send_time = m.histogram('send_seconds', 'Time to write a batch of lines to the socket')
+        self.lines_sent = m.counter('sent_lines_total', 'Lines written to the socket')
+        m.gauge('messages', 'Chat messages collected', lambda: self.msg_count)
+        m.gauge('sentences', 'Sentences generated', lambda: self.sentences_count)
+        m.gauge('vocab_words', 'Words in the model vocabulary', lambda: self.mc_bot.size()['words'])
+        m.gauge('ngrams', 'Context keys in the model', lambda: self.mc_bot.size()['keys'])
+        m.gauge('transitions', 'Transitions in the model', lambda: self.mc_bot.size()['transitions'])
+        m.gauge('model_bytes', 'Estimated bytes held by the model, refreshed every stats_interval',
+                lambda: self.model_bytes)
+        m.gauge('worker_queue', 'Jobs queued for the model worker', lambda: len(self.worker))
+        m.gauge('worker_errors', 'Model worker jobs that raised', lambda: self.worker.errors)
+        m.gauge('send_queue', 'Lines queued to be sent',
+                lambda: 0 if self.transport is None else len(self.transport))
+        m.gauge('send_dropped', 'Lines dropped because the send queue was full',
+                lambda: 0 if self.transport is None else self.transport.dropped)
+        m.gauge('read_loop_stall_max_seconds', 'Longest event loop stall seen',
+                lambda: self.stall.max)
+
+    def print_metrics(self):
+        self.print_message('metrics:\n' + self.metrics.summary())
+
+    def largest_keys(self, chan, n):
+        """
+        Write the n largest keys of the model behind chan, off the read loop.
+        """
+        self.profiler.largest_keys(asyncio.get_running_loop(), lambda: self.mc_bot,
+                                   self.model_lock, n)
 
+    def model_stats(self):
+        """
+        Return mc_bot.stats() and update the model_bytes estimate from it. The
+        caller holds model_lock.
+        """
+        stats = self.mc_bot.stats()
+        # a compacted or loaded model also holds its snapshot segment
+        self.model_bytes = stats['bytes'] + stats.get('mapped_bytes', 0)
+        self.model_bytes_time = time.monotonic()
+        return stats
+
+    def print_model_stats(self):
+        with self.model_lock:
+            stats = self.model_stats()
+        self.print_message('model: ' + ', '.join(f'{name}: {n:,}' for name, n in stats.items()))
+
+    def serve_metrics(self):
+        if self.metrics_port is not None:
+            self.metrics_server = metrics.MetricsServer(self.metrics, self.metrics_port)
+            self.metrics_server.start()
+            self.print_message(f'metrics at http://127.0.0.1:{self.metrics_server.port}/metrics')
+
+    def record_write(self, lines, seconds):
+        self.lines_sent.inc(lines)
+        self.send_time.observe(seconds)
 
     @staticmethod
     def get_user(line):
-        line = re.search(r":.+?!", line)
-        if line:
-            return line.group(0)[1:-1]
-        return ''
+        msg = irc.parse_line(line)
+        return msg.user if msg else ''
 
     @staticmethod
     def get_message(line):
-        line = re.search(r" :.+", line)
-        if line:
-            return line.group(0)[2:]
-        return ''
+        msg = irc.parse_line(line)
+        return msg.params[-1] if msg and msg.params else ''
 
     @staticmethod
     def connected(line):
@@ -64,270 +198,554 @@ class TwitchBot:
         """
         Filter message for '@' character.
         """
-        return re.sub(r'@', '', message)
+        return message.replace('@', '')
 
-    @staticmethod
-    def check_users(user):
+    def check_users(self, user):
         """
-        Check if user is a specific user.
-        In the future, read input from a .txt, but this is more convenient.
+        Check if user is on the ignored user list.
         """
-        return (user == 'nightbot') | (user == 'scootycoolguy')
+        return user in self.ignored_users
 
-    @staticmethod
-    def read_banned(file='banned.txt'):
+    def refresh_mc_bot(self, path=None):
         """
-        Read a list of banned words from banned.txt. If not present, ignore
+        Start over from the model at path (default: model_path), or an empty model.
         """
-        try:
-            with open(file) as f:
-                words = f.read()
-            return re.split(r',', words)
-        except FileNotFoundError:
-            print("Alert: banned.txt not found. ")
-            return ""
-
-    def refresh_mc_bot(self):
-        if self.order == 1:
-            self.mc_bot = mcb.MCBot()
+        path = path or self.model_path
+        if path:
+            self.mc_bot = mcb.MarkovModel.load(path, mmap=True, track=False)
+            self.order = self.mc_bot.order
+            if self.seed_cap is not None:
+                self.mc_bot.seed_cap = self.seed_cap
+                self.mc_bot.seeds = mcb.SeedReservoir(self.order, self.seed_cap)
+            if self.reply:
+                self.mc_bot.enable_keyword_index()
         else:
-            self.mc_bot = mcb.MCBot2()
+            model_class = mcb.BackoffModel if self.backoff else mcb.MarkovModel
+            self.mc_bot = model_class(order=self.order, seed_cap=self.seed_cap,
+                                      keyword_index=self.reply)
+        if self.window_messages is not None or self.window_seconds is not None:
+            self.window = window.SlidingWindow(self.mc_bot, max_messages=self.window_messages,
+                                               max_age=self.window_seconds)
+        elif self.half_life is not None:
+            self.window = window.ExponentialDecay(self.mc_bot, self.half_life)
 
     def contains_banned(self, message):
         """
         Check message for banned words.
         """
-        if self.banned == "":
-            return False
-        else:
-            line = set(message.split(' '))
-            for b in self.banned:
-                if b in line:
-                    return True
-        return False
+        start = time.perf_counter()
+        found = self.banned.search(message)
+        self.banned_time.observe(time.perf_counter() - start)
+        if found:
+            self.banned_total.inc()
+        return found
+
+    def prune_banned(self, matcher):
+        """
+        Queue the removal of transitions containing newly banned words (matched
+        by matcher) on the model worker, as a full pass over the model would stall
+        the read loop. It runs after the messages already queued.
+        """
+        self.worker.call(lambda: self.prune_model(matcher))
+
+    def prune_model(self, matcher):
+        """
+        Remove transitions containing words matched by matcher from the model. Runs on the worker thread.
+        """
+        with self.model_lock:
+            removed = self.mc_bot.prune(matcher.search)
+            self.sentence_pool.clear()
+        self.print_message(f'pruned {removed} transitions with newly banned words')
 
     def connect(self, host, port, auth, channel):
         """
-        Connect to the IRC server specified by HOST, PORT, AUTH, and CHANNEL.
-        These should be specified in auth.py
+        Set the IRC server specified by HOST, PORT, AUTH, and CHANNEL.
+        These should be specified in auth.py. The connection itself is
+        opened by run().
         """
         self.channel = channel
         self.host = host
         self.port = port
         self.auth = auth
-        self.s.connect((host, port))
-        self.s.send(f"PASS {auth} \r\n".encode(self.encoding))
-        self.s.send(f"NICK {self.user} \r\n".encode(self.encoding))
-        self.s.send(f"JOIN #{channel} + \r\n".encode(self.encoding))
-        self.join()
 
-    def join(self):
+    def new_transport(self):
+        return irc.IRCConnection(self.host, self.port, encoding=self.encoding,
+                                 on_ping=lambda line: self.print_message('PONG was sent.'),
+                                 on_write=self.record_write)
+
+    async def open(self):
+        """
+        Open the connection, log in and join the channel.
+        """
+        self.transport = self.new_transport()
+        await self.transport.open()
+        self.transport.send(f"PASS {self.auth} ")
+        self.transport.send(f"NICK {self.user} ")
+        self.transport.send(f"JOIN #{self.channel} + ")
+        await self.join()
+
+    async def join(self):
         """
         Join the server specified by CHANNEL.
         """
-        read_buffer = ""
         connecting = True
         while connecting:
-            read_buffer = read_buffer + self.s.recv(1024).decode()
-            temp = str.split(read_buffer, "\n")
-            read_buffer = temp.pop()
-            for line in temp:
-                print(line)
-                connecting = self.connected(line)
+            line = await self.transport.readline()
+            if line is None:
+                raise ConnectionError(f'connection closed while joining #{self.channel}')
+            print(line)
+            connecting = self.connected(line)
         self.print_message(f'#{self.channel} joined')
 
-    def send_message(self, message):
+    def send_message(self, message, channel=None):
         """
-        Send a message to the server.
+        Queue a message to be sent to channel (default: the bot's channel).
         """
-        message_temp = f"PRIVMSG #{self.channel} :{message}"
-        self.s.send((message_temp + "\r\n").encode("utf-8"))
-        self.print_message(f'sent: {message}')
+        channel = self.channel if channel is None else channel
+        if self.transport.send_privmsg(channel, message):
+            self.print_message(f'sent: {message}')
+        else:
+            self.print_message(f'send queue full, dropped: {message}')
 
-    def check_admin(self, user, message):
+    def check_admin(self, user, message, chan=None):
         """
         Check if user is the dedicated admin account. Several commands can be run
-        if detected in chat:
+        if detected in chat. Channel settings are changed on chan, the channel
+        the command was sent in (the bot itself for a single-channel bot):
 
         - wait[seconds] will change the wait time to [seconds]
         - count will print total message count to console
-        - write will toggle whether logs will be written upon shutdown
+        - write will toggle whether generated sentences are written to the log
         - post will toggle post mode
         - limit[num] will limit the length of markov sentences to [num]
         - refresh will toggle refresh mode
         - status will print bot status to console
+        - profile[seconds] will run cProfile on the read loop and model worker for [seconds]
+        - memsnap will write a tracemalloc snapshot and its diff with the previous one
+        - memstop will stop tracemalloc
+        - topkeys[num] will write the [num] model keys with the most successors
         - exit will shutdown the bot
+
+        Profiling results are written to data/profiles.
         """
         if self.admin == '':
             return ''
         if user == self.admin:
+            chan = self if chan is None else chan
             self.print_message(f'{user} detected: message was: {message}')
             if 'wait' in message:
-                self.wait = int(message[4:])
-                self.print_message(f'wait changed to {self.wait}')
+                chan.wait = int(message[4:])
+                self.print_message(f'wait changed to {chan.wait}')
             if 'count' in message:
-                self.print_message(f'{self.msg_count}messages collected')
+                self.print_message(f'{chan.msg_count}messages collected')
             if 'write' in message:
                 self.write = not self.write
                 self.print_message(f'write mode: {self.write}')
             if 'post' in message:
-                self.post = not self.post
-                self.print_message(f'post mode: {self.post}')
+                chan.post = not chan.post
+                self.print_message(f'post mode: {chan.post}')
             if 'limit' in message:
-                self.word_limit = int(message[5:])
-                self.print_message(f'word limit changed to {self.word_limit}')
+                chan.word_limit = int(message[5:])
+                if chan is self:
+                    self.sentence_pool.word_limit = self.word_limit
+                    self.sentence_pool.clear()
+                self.print_message(f'word limit changed to {chan.word_limit}')
             if 'refresh' in message:
-                self.refresh = not self.refresh
-                self.print_message(f'refresh mode: {self.refresh}')
+                chan.refresh = not chan.refresh
+                self.print_message(f'refresh mode: {chan.refresh}')
             if 'status' in message:
-                self.status_update()
+                self.status_update(chan)
+            if 'profile' in message:
+                seconds = float(message[7:] or 10)
+                worker = self.worker if self.worker.thread is not None else None
+                self.profiler.profile(asyncio.get_running_loop(), worker, seconds)
+            if 'memsnap' in message:
+                self.profiler.memory_snapshot(asyncio.get_running_loop())
+            if 'memstop' in message:
+                self.profiler.stop_tracing()
+            if 'topkeys' in message:
+                self.largest_keys(chan, int(message[7:] or 20))
             if "exit" in message:
                 self.online = False
                 self.print_message('going offline')
-                self.print_message(f'@ count was {self.at_count}')
+                self.print_message(f'@ count was {chan.at_count}')
                 return 'exit'
             return ''
 
-    def status_update(self):
+    def status_update(self, chan=None):
         """
-        Print bot status to console.
+        Print bot status to console, with the settings of chan (default: the bot's own).
         """
-        self.print_message(f'msg_count: {self.msg_count} at_count: {self.at_count}\n' +
-                           f'post: {self.post} online: {self.online} refresh: {self.refresh} write: {self.write}\n' +
-                           f'word_limit: {self.word_limit} wait: {self.wait}')
-
-    def update_logs(self, message):
+        chan = self if chan is None else chan
+        self.print_message(f'msg_count: {chan.msg_count} at_count: {chan.at_count}\n' +
+                           f'post: {chan.post} online: {self.online} refresh: {chan.refresh} write: {self.write}\n' +
+                           f'word_limit: {chan.word_limit} wait: {chan.wait}')
+        if chan is self:
+            state = 'running' if self.worker.alive() else 'stopped'
+            self.print_message(f'{self.stall.summary()}, worker {state}, queue: {len(self.worker)}, '
+                               f'errors: {self.worker.errors}')
+            if self.dedup is not None:
+                self.print_message(self.dedup.summary())
+            if self.transport is not None:
+                self.print_message(self.transport.summary())
+            self.print_metrics()
+            if self.loop is None:
+                self.print_model_stats()
+            else:
+                # walking the model for its size in bytes could stall the read loop
+                self.loop.run_in_executor(None, self.print_model_stats)
+
+    def update_logs(self, message, chan=None, user=''):
         """
-        Update the the log of all collected messages and the message buffer for the markov bot.
-        For now, disable the collection of all logs. Only use for debugging/data collection purposes.
+        Add a message to the message buffer for the markov bot, and to the chat log if log_chat is set.
+        The chat log is off by default. Only use for debugging/data collection purposes.
         Note that the collection of chat logs is (probably) against Twitch TOS.
         """
-        # self.all_logs[self.curr_time] = message
-        self.msg_buffer.append(message)
-        self.msg_count += 1
-
-    def update_sentences(self, sentence):
+        chan = self if chan is None else chan
+        if self.chat_log is not None:
+            channel = self.channel if chan is self else chan.name
+            self.chat_log.write({'time': self.curr_time, 'channel': channel, 'user': user,
+                                 'text': message})
+        chan.msg_buffer.append(message)
+        chan.msg_count += 1
+        if self.checkpoints is not None and chan is self:
+            self.checkpoints.wal.append(self.msg_count, message)
+
+    def update_sentences(self, sentence, channel=None):
         """
-        Update the log of generated markov sentences.
+        Count a generated markov sentence and, in write mode, add it to the sentence log.
         """
-        self.markov_sentences[self.curr_time] = sentence
         self.sentences_count += 1
+        if self.write:
+            self.sentence_log.write({'time': self.curr_time, 'channel': channel or self.channel,
+                                     'text': sentence})
+
+    def ready(self, chan=None, lead=0):
+        """
+        Check if <wait> time since the last bot posting in chan (default: the bot's own channel),
+        or if it will be in lead seconds.
+        """
+        chan = self if chan is None else chan
+        return self.curr_time > chan.last_time + chan.wait - lead
 
-    def ready(self):
+    def close_logs(self):
         """
-        Check if <self.wait> time since the last bot posting.
+        Write out and close the sentence and chat logs.
         """
-        return self.curr_time > self.last_time + self.wait
+        self.sentence_log.close()
+        if self.chat_log is not None:
+            self.chat_log.close()
+        self.print_message(f'{self.sentence_log.records} sentences logged')
 
-    def write_logs(self, file='logs.txt'):
+    def next_sentence(self):
+        """
+        Pop a pre-generated sentence from the pool, or generate one inline if it's empty.
         """
-        Write collected chat logs to /data/logs/logs.txt.
-        Currently, this function is never actually called, but
-        is here for dev purposes.
+        sentence = self.sentence_pool.pop()
+        if sentence is None:
+            with self.model_lock:
+                sentence = self.mc_bot.generate_sentence(word_limit=self.word_limit,
+                                                         cap_first=True, end_punc='.')
+        return sentence
+
+    async def shutdown(self):
+        self.stall.stop()
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+        if self.checkpoint_task is not None:
+            self.checkpoint_task.cancel()
+        # lets the worker finish queued jobs, including a requested post
+        await asyncio.to_thread(self.worker.stop)
+        self.sentence_pool.stop()
+        if self.checkpoints is not None:
+            # the worker is stopped, so the buffer can be trained on here
+            self.ingest(self.msg_buffer)
+            self.msg_buffer.clear()
+            await asyncio.to_thread(self.final_checkpoint)
+        self.close_logs()
+        await self.transport.close()
+
+    def checkpoint_state(self):
+        return {'seq': self.ingested, 'sentences_count': self.sentences_count,
+                'at_count': self.at_count, 'wait': self.wait, 'word_limit': self.word_limit,
+                'post': self.post, 'time': time.time()}
+
+    def restore(self):
         """
-        if self.all_logs == {}:
+        Load the last checkpoint, if there is one, and train on the messages
+        logged after it.
+        """
+        start = time.perf_counter()
+        path, state = self.checkpoints.load()
+        if path is not None:
+            self.refresh_mc_bot(path)
+            if self.window is not None and not self.window.load_state(
+                    self.checkpoints.load_window(state)):
+                # counts that no window holds would never be taken out of the model again
+                self.print_message('the checkpoint has no state for this window, '
+                                   'its model is not restored')
+                self.refresh_mc_bot()
+            self.ingested = self.msg_count = state['seq']
+            self.sentences_count = state['sentences_count']
+            self.at_count = state['at_count']
+            self.wait = state['wait']
+            self.word_limit = self.sentence_pool.word_limit = state['word_limit']
+            self.post = state['post']
+        messages = []
+        for seq, text in self.checkpoints.wal.records(self.ingested):
+            messages.append(text)
+            self.msg_count = seq
+        self.ingest(messages)
+        if path is not None or messages:
+            self.print_message(f'restored {self.ingested} messages ({len(messages)} from the log) '
+                               f'in {time.perf_counter() - start:.1f}s')
+
+    def request_checkpoint(self):
+        # a new log segment starts here; the old ones can go once every message
+        # in them is trained on, which is certain if none are left in the buffer
+        segment = None if self.msg_buffer else self.checkpoints.wal.rotate()
+        self.worker.call(lambda: self.write_checkpoint(segment))
+
+    def write_checkpoint(self, segment=None):
+        """
+        Start a checkpoint of the model. Runs on the worker thread, which the
+        model is only held from while the checkpoint process is forked.
+        """
+        start = time.perf_counter()
+        with self.model_lock:
+            started = self.checkpoints.save(self.mc_bot, self.checkpoint_state(), segment,
+                                            self.window)
+        self.checkpoint_time.observe(time.perf_counter() - start)
+        if not started:
+            self.print_message('previous checkpoint still being written, skipped')
+
+    def final_checkpoint(self):
+        self.checkpoints.busy(wait=True)
+        self.write_checkpoint(self.checkpoints.wal.rotate())
+        self.checkpoints.close()
+        self.print_message(f'checkpoint written, {self.ingested} messages')
+
+    async def checkpoint_loop(self):
+        while True:
+            await asyncio.sleep(self.checkpoint_interval)
+            self.request_checkpoint()
+
+    def handle_line(self, line, chan=None):
+        """
+        Process one line from the server, for chan (default: the bot's own
+        channel). Lines other than PRIVMSG are dropped without further parsing.
+        Returns True if it was a chat message that was added to the message buffer.
+        """
+        start = time.perf_counter()
+        msg = irc.parse_privmsg(line)
+        self.parse_time.observe(time.perf_counter() - start)
+        self.lines_read.inc()
+        if msg is None:
+            return False
+        return self.handle_message(msg, chan)
+
+    def handle_message(self, msg, chan=None):
+        """
+        Process a parsed PRIVMSG, see handle_line.
+        """
+        chan = self if chan is None else chan
+        self.curr_time = time.time()
+        user = msg.user
+        message = msg.text
+
+        # if someone @s the bot
+        mentioned = self.user in message
+        if mentioned:
+            self.print_message(f'{user} @ed me. msg: {message}')
+            chan.at_count += 1
+
+        # skip message if contains banned words
+        if self.contains_banned(message):
+            return False
+
+        # prevent bot from @ing people
+        message = self.filter_at(message)
+
+        # check if user is admin
+        self.check_admin(user, message, chan)
+
+        # end run loop
+        if not self.online:
+            return False
+
+        if self.check_users(user):
+            return False
+        if self.dedup is not None:
+            start = time.perf_counter()
+            duplicate = self.dedup.is_duplicate(message, self.curr_time)
+            self.dedup_time.observe(time.perf_counter() - start)
+            if duplicate:
+                return False
+        if mentioned and self.reply and chan is self:
+            self.request_reply(message)
+        self.update_logs(message, chan, user)
+        return True
+
+    def ingest(self, messages):
+        """
+        Train the model on a batch of messages. Runs on the worker thread.
+        """
+        with self.model_lock:
+            add_text = self.mc_bot.add_text if self.window is None else self.window.add_text
+            # oldest first, so that a window keeps the most recent messages
+            observe = self.add_text_time.observe
+            for message in messages:
+                start = time.perf_counter()
+                add_text(message)
+                observe(time.perf_counter() - start)
+            if self.window is not None:
+                self.window.expire()
+            if not isinstance(self.window, window.SlidingWindow):
+                # move the bulk of a long-running model into compact rows; a sliding
+                # window keeps its model small, and rewrites it message by message
+                self.mc_bot.compact(mcb.COMPACT_KEYS)
+            self.ingested += len(messages)
+            if time.monotonic() - self.model_bytes_time >= self.stats_interval:
+                self.model_stats()
+
+    def generate(self):
+        """
+        Return a markov sentence to post, then refresh the model if refresh mode
+        is on. Runs on the worker thread, after every message queued before the request.
+        """
+        if self.window is not None:
+            with self.model_lock:
+                self.window.expire()
+        start = time.perf_counter()
+        sentence = self.next_sentence()
+        self.generate_time.observe(time.perf_counter() - start)
+        if self.refresh:
+            with self.model_lock:
+                self.refresh_mc_bot()
+                self.sentence_pool.clear()
+        else:
+            self.sentence_pool.notify()
+        return sentence
+
+    def deliver_sentence(self, sentence):
+        """
+        Hand a sentence from the worker thread back to the event loop to be posted.
+        """
+        try:
+            self.loop.call_soon_threadsafe(self.post_sentence, sentence)
+        except RuntimeError:
+            # the loop has already closed
+            if sentence is not None:
+                self.print_message(f'not posted: {sentence}')
+
+    def post_sentence(self, sentence):
+        self.curr_time = time.time()
+        self.last_time = self.curr_time
+        self.post_pending = False
+        self.pool_refilled = False
+        if sentence is None:
+            # generation failed and the worker reported it; try again after the usual wait
             return
-        time_str = time.strftime('%Y-%m-%d_%H_%M', time.localtime(time.time()))
-        newpath = 'data\\logs\\'
-        if not os.path.exists(newpath):
-            os.makedirs(newpath)
-        rel_path = ''.join([newpath, time_str, file])
-        curr_dir = os.path.dirname(__file__)
-        abs_path = os.path.join(curr_dir, rel_path)
-
-        with open(abs_path, 'w', encoding=self.encoding) as f:
-            f.write(str(self.all_logs))
-        self.print_message(f'All logs written at {time_str}')
-
-    def write_markov_sentences(self, file='markov.txt'):  # writes all generated sentences
-        """
-        Write generated markov sentences to /data/logs/markov.txt
-        """
-        time_str = time.strftime('%Y-%m-%d_%H-%M', time.localtime(time.time()))
-        newpath = 'data\\logs\\'
-        if not os.path.exists(newpath):
-            os.makedirs(newpath)
-        rel_path = ''.join([newpath, time_str, file])
-        curr_dir = os.path.dirname(__file__)
-        abs_path = os.path.join(curr_dir, rel_path)
-
-        output = '\n\n'.join(list(self.markov_sentences.values()))
-        with open(abs_path, 'w', encoding=self.encoding) as f:
-            f.write(output)
-        self.print_message(f'Markov sentences written at {time_str}')
-
-    def shutdown(self):
-        if self.write:
-            # self.write_logs()
-            self.write_markov_sentences()
-        # close socket
-        self.s.close()
 
-    def run(self):
+        # if post mode is disabled, bot will print to console
+        if self.post:
+            self.send_message(sentence)
+        else:
+            self.print_message(sentence)
+        self.update_sentences(sentence)
+
+    def request_reply(self, message):
+        """
+        Ask the worker for a reply to message, unless one is already on its way.
+        """
+        if self.reply_pending:
+            return
+        self.reply_pending = True
+        user = self.user.lower()
+        words = [w for w in message.split() if user not in w.lower()]
+        self.worker.call(lambda: self.generate_reply(words))
+
+    def generate_reply(self, words):
+        """
+        Generate a reply around one of words and hand it to the event loop. Runs on the worker thread.
+        """
+        start = time.perf_counter()
+        sentence = ''
+        try:
+            with self.model_lock:
+                sentence = self.mc_bot.generate_reply(words, word_limit=self.word_limit)
+        finally:
+            # hand back even a failed reply, so that the next one can be requested
+            self.reply_time.observe(time.perf_counter() - start)
+            try:
+                self.loop.call_soon_threadsafe(self.post_reply, sentence)
+            except RuntimeError:
+                self.print_message(f'not posted: {sentence}')
+
+    def post_reply(self, sentence):
+        self.reply_pending = False
+        if not sentence:
+            return
+        if self.post:
+            self.send_message(sentence)
+        else:
+            self.print_message(sentence)
+        self.update_sentences(sentence)
+
+    def feed_worker(self):
+        """
+        Move buffered messages onto the worker's queue. Any that don't fit stay
+        in the buffer and are retried with the next message.
+        """
+        queued = 0
+        for message in self.msg_buffer:
+            if not self.worker.put_text(message):
+                break
+            queued += 1
+        del self.msg_buffer[:queued]
+
+    async def process(self):
+        """
+        Consume lines from the transport until the bot goes offline or the
+        connection closes. Messages are passed straight to the model worker,
+        which also generates the posts, so reading never waits on the model.
+        """
+        while self.online:
+            line = await self.transport.readline()
+            if line is None:
+                self.print_message('connection closed')
+                break
+            if not self.handle_line(line):
+                continue
+            self.feed_worker()
+
+            # shortly before posting, regenerate the pool once the queued chat is trained on,
+            # so the post reflects it (and a pool emptied by a refresh is filled again)
+            if not self.pool_refilled and self.ready(lead=self.pool_lead):
+                self.pool_refilled = True
+                self.worker.call(self.sentence_pool.clear)
+
+            # if bot is ready to post, ask the worker for a markov sentence
+            if self.ready() and not self.post_pending:
+                self.post_pending = True
+                self.worker.request_post()
+
+    async def main(self):
+        await self.open()
         self.last_time = time.time()
         self.online = True
-        read_buffer = ""
         self.status_update()
-        while self.online:
-            try:
-                # read from the socket input stream
-                read_buffer = read_buffer + self.s.recv(1024).decode()
-            except UnicodeDecodeError:
-                self.print_message('UnicodeDecodeError: skipping line')
-                continue
-            current = str.split(read_buffer, "\n")
-            read_buffer = current.pop()
-
-            for line in current:
-                # respond to PING afk check, which occurs at unknown time intervals
-                if line == 'PING :tmi.twitch.tv':
-                    self.s.send(("PONG" + "\r\n").encode(self.encoding))
-                    self.print_message('PONG was sent.')
-                    continue
-                self.curr_time = time.time()
-                user = self.get_user(line)
-                message = self.get_message(line)
-
-                # if someone @s the bot
-                if self.user in message:
-                    self.print_message(f'{user} @ed me. msg: {message}')
-                    self.at_count += 1
-
-                # skip message if contains banned words
-                if self.contains_banned(message):
-                    continue
-
-                # prevent bot from @ing people
-                message = self.filter_at(message)  
-                
-                # check if user is admin
-                self.check_admin(user, message) 
-
-                # end run loop
-                if not self.online:
-                    break
-
-                if self.check_users(user):
-                    continue
-                else:
-                    self.update_logs(message)
-
-                # if bot is ready to post, then generate a markov sentence
-                if self.ready():
-                    while len(self.msg_buffer) > 0:
-                        self.mc_bot.add_text(self.msg_buffer.pop())
-                    sentence = self.mc_bot.generate_sentence(word_limit=self.word_limit,
-                                        cap_first=True, end_punc='.')
-                    self.curr_time = time.time()
-                    self.last_time = self.curr_time
-
-                    # if post mode is disabled, bot will print to console
-                    if self.post:
-                        self.send_message(sentence)
-                    else:
-                        self.print_message(sentence)
-                    self.update_sentences(sentence)
-                    if self.refresh:
-                        self.refresh_mc_bot()
-                        self.msg_buffer = []
-        self.shutdown()
+        self.loop = asyncio.get_running_loop()
+        self.stall.start()
+        self.serve_metrics()
+        self.worker.start()
+        self.sentence_pool.start()
+        if self.checkpoints is not None:
+            self.checkpoint_task = asyncio.create_task(self.checkpoint_loop())
+        try:
+            await self.process()
+        finally:
+            await self.shutdown()
+
+    def run(self):
+        asyncio.run(self.main())
@@ -0,0 +1,147 @@
+import time
+from array import array
+from collections import deque
+
+
+class SlidingWindow():
+    """
+    Trains a model on a sliding window of recent messages: the last
+    max_messages messages and/or the ones younger than max_age seconds.
+
+    When a message leaves the window its n-gram counts are subtracted again,
+    so transitions and keys that reach zero are removed, and words first seen
+    through the window are released once no message in the window uses them.
+    Every message is added and expired exactly once, so upkeep is amortized
+    O(tokens) and memory is bounded by the window. The model should only be
+    trained through the window.
+    """
+    def __init__(self, model, max_messages=None, max_age=None):
+        if max_messages is None and max_age is None:
+            raise ValueError('a window needs max_messages or max_age')
+        self.model = model
+        self.max_messages = max_messages
+        self.max_age = max_age
+        self.messages = deque()  # (time added, array('I') of token ids)
+        self.word_refs = {}  # token id -> occurrences in the window
+        self.owned = set()  # token ids created by the window, released at zero references
+
+    def __len__(self):
+        return len(self.messages)
+
+    def state(self):
+        """
+        Return the messages in the window and the words it owns as JSON
+        values, to be restored over a copy of the model with load_state.
+        """
+        return {'type': 'sliding', 'messages': [[t, tokens.tolist()] for t, tokens in self.messages],
+                'owned': sorted(self.owned)}
+
+    def load_state(self, state):
+        """
+        Take over the messages of a window saved with state, whose counts are
+        already in the model. Returns False if state is from another kind of window.
+        """
+        if state is None or state.get('type') != 'sliding':
+            return False
+        self.messages = deque((t, array('I', tokens)) for t, tokens in state['messages'])
+        refs = {}
+        for _, tokens in self.messages:
+            for token in tokens:
+                refs[token] = refs.get(token, 0) + 1
+        self.word_refs = refs
+        self.owned = set(state['owned'])
+        return True
+
+    def add_text(self, text, now=None):
+        """
+        Add a message to the model and the window, then expire old messages.
+        """
+        now = time.time() if now is None else now
+        model, refs, owned = self.model, self.word_refs, self.owned
+        tokens = array('I')
+        for word in text.split():
+            token = model.token(word)
+            if token is None:
+                token = model.intern(word)
+                owned.add(token)
+            tokens.append(token)
+            refs[token] = refs.get(token, 0) + 1
+        model.update_tokens(tokens)
+        model.add_seed(tokens)
+        model.word_count += len(tokens)
+        self.messages.append((now, tokens))
+        self.expire(now)
+
+    def expire(self, now=None):
+        """
+        Remove messages that have fallen out of the window from the model.
+        """
+        now = time.time() if now is None else now
+        messages, refs, owned, model = self.messages, self.word_refs, self.owned, self.model
+        oldest = None if self.max_age is None else now - self.max_age
+        while messages and ((self.max_messages is not None and len(messages) > self.max_messages)
+                            or (oldest is not None and messages[0][0] < oldest)):
+            _, tokens = messages.popleft()
+            model.update_tokens(tokens, remove=True)
+            for token in tokens:
+                n = refs[token] - 1
+                if n:
+                    refs[token] = n
+                    continue
+                del refs[token]
+                if token in owned and model.release_word(token):
+                    owned.discard(token)
+
+
+class ExponentialDecay():
+    """
+    Trains a model on every message while its counts decay exponentially
+    with the given half_life in seconds, so old chat fades out instead of
+    being dropped all at once. Counts are decayed every interval seconds
+    (default: a quarter of half_life), and transitions that decay to zero are
+    removed, then words that no row refers to any more are released. Each
+    decay pass is O(model size), and the model and its vocabulary stay
+    bounded by roughly the number of tokens seen per half-life.
+    """
+    def __init__(self, model, half_life, interval=None):
+        self.model = model
+        self.half_life = half_life
+        self.interval = half_life / 4 if interval is None else interval
+        self.last_decay = None
+
+    def state(self):
+        return {'type': 'decay', 'last_decay': self.last_decay}
+
+    def load_state(self, state):
+        """
+        Continue the decay clock of a window saved with state. Returns False
+        if state is from another kind of window.
+        """
+        if state is None or state.get('type') != 'decay':
+            return False
+        self.last_decay = state['last_decay']
+        return True
+
+    def add_text(self, text, now=None):
+        """
+        Add a message to the model, then decay it if an interval has passed.
+        """
+        self.model.add_text(text)
+        self.expire(now)
+
+    def expire(self, now=None):
+        """
+        Decay the model by the time elapsed since the last decay, once at least an interval has passed.
+        """
+        now = time.time() if now is None else now
+        if self.last_decay is None:
+            self.last_decay = now
+        elapsed = now - self.last_decay
+        if elapsed < self.interval:
+            return
+        model = self.model
+        model.decay(0.5 ** (elapsed / self.half_life))
+        for token in model.unused_words():
+            if not model.release_word(token):
+                break  # ids are kept while changes are tracked for delta snapshots
+        self.last_decay = now
@@ -0,0 +1,165 @@
+import asyncio
+import queue
+import threading
+import time
+import traceback
+
+POST = object()  # job asking the worker for a sentence to post
+STOP = object()
+
+
+class ModelWorker():
+    """
+    Thread that owns model ingestion and sentence generation, so the IRC read
+    loop only ever puts messages on a queue. The queue holds up to queue_size
+    messages; post requests are always accepted, so a backlog of chat can't
+    hold up posting.
+
+    Jobs are handled in the order they're queued: each chat message is passed
+    to ingest (consecutive messages are taken as one batch), each post
+    request calls generate and hands the sentence to deliver, still on the
+    worker thread, and other callables are just called there. deliver is
+    expected to pass the sentence back to the event loop.
+
+    A job that raises is reported with print_message and counted in errors,
+    and the worker goes on with the next one. If generate raises, deliver
+    gets None, so the requester knows no sentence is coming.
+    """
+    def __init__(self, ingest, generate, deliver, queue_size=4096, batch=256,
+                 print_message=print):
+        self.ingest = ingest
+        self.generate = generate
+        self.deliver = deliver
+        self.batch = batch
+        self.queue_size = queue_size
+        self.print_message = print_message
+        self.jobs = queue.SimpleQueue()
+        self.thread = None
+        self.errors = 0  # jobs that raised
+
+    def __len__(self):
+        return self.jobs.qsize()
+
+    def alive(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self.run, name='model-worker', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Finish the queued jobs, then stop the thread.
+        """
+        if self.thread is None:
+            return
+        self.jobs.put(STOP)
+        self.thread.join()
+        self.thread = None
+
+    def put_text(self, text):
+        """
+        Queue a message for ingestion without waiting. Returns False if the queue is full.
+        """
+        if self.jobs.qsize() >= self.queue_size:
+            return False
+        self.jobs.put(text)
+        return True
+
+    def request_post(self):
+        """
+        Queue a post request, to be handled after the messages already queued.
+        """
+        self.jobs.put(POST)
+
+    def call(self, fn):
+        """
+        Queue fn to be called on the worker thread, after the jobs already queued.
+        """
+        self.jobs.put(fn)
+
+    def run(self):
+        jobs = self.jobs
+        held = None  # job taken off the queue while batching, handled next
+        while True:
+            job = jobs.get() if held is None else held
+            held = None
+            if job is STOP:
+                break
+            if job is POST:
+                sentence = None
+                try:
+                    sentence = self.generate()
+                except Exception:
+                    self.report('generating a sentence')
+                self.deliver(sentence)
+                continue
+            if callable(job):
+                try:
+                    job()
+                except Exception:
+                    self.report('a queued call')
+                continue
+            # take the run of messages queued behind this one, so they're ingested under one lock
+            texts = [job]
+            while len(texts) < self.batch:
+                try:
+                    job = jobs.get_nowait()
+                except queue.Empty:
+                    break
+                if not isinstance(job, str):
+                    held = job
+                    break
+                texts.append(job)
+            try:
+                self.ingest(texts)
+            except Exception:
+                self.report(f'ingesting {len(texts)} messages')
+
+    def report(self, what):
+        self.errors += 1
+        self.print_message(f'model worker: {what} failed\n{traceback.format_exc().rstrip()}')
+
+
+class StallMeter():
+    """
+    Measures how long the event loop goes without running its tasks. A task
+    sleeps for interval seconds at a time, and any time it oversleeps by is
+    time the loop was stalled, e.g. by the read loop doing blocking work.
+    """
+    def __init__(self, interval=.05):
+        self.interval = interval
+        self.samples = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.task = None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run(), name='stall-meter')
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def run(self):
+        interval = self.interval
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(interval)
+            self.record(max(0.0, time.perf_counter() - start - interval))
+
+    def record(self, stall):
+        self.samples += 1
+        self.total += stall
+        if stall > self.max:
+            self.max = stall
+
+    def mean(self):
+        return self.total / self.samples if self.samples else 0.0
+
+    def summary(self):
+        return f'read loop stall: mean {1000 * self.mean():.2f} ms, max {1000 * self.max:.2f} ms'